@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import random
+import string
+import zipfile
+import argparse
+import resource
+import tempfile
+import subprocess
+import threading
+import importlib.util
+import concurrent.futures
+import http.server
+import platform
+import sqlite3
+from pathlib import Path
+from tabulate import tabulate
+
+##########################################
+# Offline benchmark for chaos-downloader
+#
+# Serves a synthetic index.json and program zips from a local HTTP server,
+# runs the real download -> unzip -> ingest -> diff path of
+# chaos-downloader.py against it and reports per-stage throughput, peak
+# RSS and database size as JSON.
+##########################################
+SCRIPT_PATH = Path(__file__).resolve().parent / "chaos-downloader.py"
+SAVE_DIR = "bench_programmes"
+
+##########################################
+# Synthetic Chaos data
+##########################################
+def random_label(rng, length):
+    return "".join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(length))
+
+def program_lines(rng, domains, lines):
+    # Deterministic subdomains spread over a few root domains per program
+    for i in range(lines):
+        yield f"{random_label(rng, rng.randint(3, 12))}{i}.{domains[i % len(domains)]}\n"
+
+def write_program_zip(path, name, lines, files, seed):
+    rng = random.Random(f"{name}-{seed}")
+    domains = [f"{name}-{d}.example" for d in range(files)]
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for domain in domains:
+            zf.writestr(f"{domain}.txt", "".join(
+                line for line in program_lines(rng, domains, lines) if line.rstrip().endswith(domain)
+            ))
+
+def generate_dataset(root, port, programs, lines, files, seed=0, changed=()):
+    # Writes program zips and index.json into root; programs in `changed` get fresh lines
+    index = []
+    for i in range(programs):
+        name = f"program{i}"
+        write_program_zip(root / f"{name}.zip", name, lines, files, 0)
+        if name in changed:
+            # Keep the old list and add ~1% new names, like a real daily update
+            rng = random.Random(f"{name}-extra-{seed}")
+            with zipfile.ZipFile(root / f"{name}.zip", "a", zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr(f"{name}-extra.example.txt", "".join(
+                    f"{random_label(rng, 10)}{j}.{name}-extra.example\n" for j in range(max(1, lines // 100))
+                ))
+        index.append({
+            "name": name,
+            "program_url": f"https://{name}.example",
+            "URL": f"http://127.0.0.1:{port}/{name}.zip",
+            "count": lines,
+            "change": lines // 100 if name in changed else 0,
+            "is_new": False,
+            "platform": ("hackerone", "bugcrowd", "yeswehack", "")[i % 4],
+            "bounty": i % 2 == 0,
+            "last_updated": f"2026-01-{1 + seed:02d}T00:00:00Z" if name in changed or not seed else "2026-01-01T00:00:00Z",
+        })
+    (root / "index.json").write_text(json.dumps(index))
+    if seed:
+        # Last-Modified has one-second resolution; make sure regenerated files never look unchanged
+        mtime = time.time() + 2 * seed
+        for path in [root / "index.json", *(root / f"{name}.zip" for name in changed)]:
+            os.utime(path, (mtime, mtime))
+    return index
+
+def write_shared_dataset(root, port, shared, dropped=None):
+    # Two programs that both list `shared`; the `dropped` one stops listing them in a newer zip
+    index = []
+    for name in ("sharedA", "sharedB"):
+        lines = [f"{i}.{name}.example" for i in range(100)] + ([] if name == dropped else shared)
+        with zipfile.ZipFile(root / f"{name}.zip", "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr(f"{name}.example.txt", "".join(f"{line}\n" for line in lines))
+        index.append({
+            "name": name, "program_url": f"https://{name}.example", "URL": f"http://127.0.0.1:{port}/{name}.zip",
+            "count": len(lines), "change": 0, "is_new": False, "platform": "", "bounty": False,
+            "last_updated": "2026-01-02T00:00:00Z" if name == dropped else "2026-01-01T00:00:00Z",
+        })
+    (root / "index.json").write_text(json.dumps(index))
+    if dropped:
+        mtime = time.time() + 2
+        for path in (root / "index.json", root / f"{dropped}.zip"):
+            os.utime(path, (mtime, mtime))
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+def start_server(root):
+    handler = lambda *args, **kwargs: QuietHandler(*args, directory=str(root), **kwargs)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+##########################################
+# Measurements
+##########################################
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def db_size_mb(db_path):
+    return sum(os.path.getsize(p) for p in (db_path, f"{db_path}-wal") if os.path.exists(p)) / 1048576
+
+def record(results, stage, seconds, items=0, nbytes=0):
+    results[stage] = {
+        "seconds": round(seconds, 4),
+        "items": items,
+        "bytes": nbytes,
+        "items_per_sec": round(items / seconds, 1) if seconds and items else None,
+        "mb_per_sec": round(nbytes / seconds / 1048576, 2) if seconds and nbytes else None,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+def load_downloader():
+    spec = importlib.util.spec_from_file_location("chaos_downloader", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so functions can be pickled to the normalization process pool
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def run_benchmark(args, workdir):
+    www = workdir / "www"
+    www.mkdir()
+    server = start_server(www)
+    port = server.server_address[1]
+    index = generate_dataset(www, port, args.programs, args.lines, args.files)
+
+    os.environ.update({
+        "CHAOS_INDEX_URL": f"http://127.0.0.1:{port}/index.json",
+        "CHAOS_DB": str(workdir / "chaos.db"),
+        "CHAOS_DOWNLOAD_DIR": str(workdir / "downloads"),
+        "CHAOS_WORKERS": str(args.workers),
+        "CHAOS_STREAM_PROBE": "",
+    })
+    os.chdir(workdir)
+    stages = {}
+
+    started = time.perf_counter()
+    cd = load_downloader()
+    programs = cd.get_catalog().programs
+    record(stages, "index", time.perf_counter() - started, len(programs))
+
+    # Download every zip
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        downloads = list(executor.map(lambda p: cd.download(p["URL"], cd.get_file_name(p["URL"])), programs))
+    zip_paths = [path for path, _ in downloads]
+    record(stages, "download", time.perf_counter() - started, len(zip_paths), sum(p.stat().st_size for p in zip_paths))
+
+    # Read every zip member without touching the database
+    started = time.perf_counter()
+    lines = sum(sum(1 for _ in cd.iter_zip_subdomains(path)) for path in zip_paths)
+    record(stages, "unzip", time.perf_counter() - started, lines)
+
+    # Stage, diff and insert into the database
+    started = time.perf_counter()
+    run_id = cd.start_run(SAVE_DIR, len(programs))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+        new_rows = sum(executor.map(
+            lambda item: cd.ingest_zip(
+                item[1], SAVE_DIR, cd.insert_table_name(item[0]["name"], item[0]["platform"], item[0]["bounty"]), run_id
+            ),
+            zip(programs, zip_paths)
+        ))
+    cd.finish_run(run_id).result()
+    record(stages, "ingest", time.perf_counter() - started, new_rows)
+    for (program, (path, validators)) in zip(programs, downloads):
+        cd.update_cache_entry(program["URL"], validators[0], validators[1], program["last_updated"]).result()
+        cd.record_output(program["name"], SAVE_DIR, program["last_updated"])
+        path.unlink()
+
+    started = time.perf_counter()
+    cd.build_master_files(SAVE_DIR)
+    record(stages, "master", time.perf_counter() - started, lines)
+
+    # Full run with nothing changed: served from the HTTP cache
+    started = time.perf_counter()
+    cd.download_programs(programs, SAVE_DIR, probe_tool="", interactive=False)
+    record(stages, "rerun_unchanged", time.perf_counter() - started, len(programs))
+
+    # Full run after some programs changed upstream
+    changed = {p["name"] for p in index[:max(1, int(len(index) * args.changed_ratio))]}
+    generate_dataset(www, port, args.programs, args.lines, args.files, seed=1, changed=changed)
+    cd.catalog = cd.ProgramCatalog(cd.load_data())
+    started = time.perf_counter()
+    cd.download_programs(cd.catalog.programs, SAVE_DIR, probe_tool="", interactive=False)
+    new_file = workdir / f"new_{SAVE_DIR}.txt"
+    new_rows = sum(1 for _ in new_file.open()) if new_file.exists() else 0
+    record(stages, "rerun_changed", time.perf_counter() - started, new_rows)
+    if args.shards:
+        active = cd.get_connection().execute("SELECT count(*) FROM subdomains WHERE removed IS NULL;").fetchone()[0]
+        run_sharded(args, workdir, len(programs), active, stages)
+    run_shared_names(args, workdir, stages)
+
+    cd.get_db_writer().close()
+    server.shutdown()
+    return {
+        "config": vars(args) | {"output": None, "compare": None},
+        "environment": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+        },
+        "stages": stages,
+        "subdomains": lines,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "db_size_mb": round(db_size_mb(workdir / "chaos.db"), 2),
+    }
+
+def run_sharded(args, workdir, program_count, expected, stages):
+    # Sync the current dataset from scratch in N shard processes, then merge the shards into a new database
+    shard_dir = workdir / "shards"
+    shard_dir.mkdir()
+    env = dict(os.environ, CHAOS_DOWNLOAD_DIR=str(shard_dir / "downloads"))
+    env.pop("CHAOS_DB")  # every shard uses its own chaos_shard<i>of<N>.db
+    started = time.perf_counter()
+    workers = [
+        subprocess.Popen(
+            [sys.executable, __file__, "--sync-worker"], cwd=shard_dir,
+            env=dict(env, CHAOS_SHARD=f"{i}/{args.shards}"), stdout=subprocess.DEVNULL
+        )
+        for i in range(1, args.shards + 1)
+    ]
+    if any(worker.wait() for worker in workers):
+        raise SystemExit("a shard worker failed")
+    record(stages, "sharded_sync", time.perf_counter() - started, program_count)
+
+    started = time.perf_counter()
+    subprocess.run(
+        [sys.executable, str(SCRIPT_PATH), "merge", "--dir", SAVE_DIR, *sorted(str(p) for p in shard_dir.glob("chaos_shard*.db"))],
+        cwd=shard_dir, env=dict(env, CHAOS_DB="merged.db"), stdout=subprocess.DEVNULL, check=True
+    )
+    with sqlite3.connect(shard_dir / "merged.db") as conn:
+        merged = conn.execute("SELECT count(*) FROM subdomains WHERE removed IS NULL;").fetchone()[0]
+    record(stages, "merge", time.perf_counter() - started, merged)
+    if merged != expected:
+        raise SystemExit(f"merged shards hold {merged} subdomains, the single-process run {expected}")
+
+def run_shared_names(args, workdir, stages):
+    # Regression check: a name two programs list stays current when only its owner drops it
+    shared_dir = workdir / "shared"
+    (shared_dir / "www").mkdir(parents=True)
+    server = start_server(shared_dir / "www")
+    port = server.server_address[1]
+    shared = [f"{i}.shared.example" for i in range(max(1, args.lines // 100))]
+    env = dict(
+        os.environ, CHAOS_DB="shared.db", CHAOS_DOWNLOAD_DIR=str(shared_dir / "downloads"),
+        CHAOS_INDEX_URL=f"http://127.0.0.1:{port}/index.json"
+    )
+    sync = lambda: subprocess.run(
+        [sys.executable, __file__, "--sync-worker"], cwd=shared_dir, env=env, stdout=subprocess.DEVNULL, check=True
+    )
+    write_shared_dataset(shared_dir / "www", port, shared)
+    sync()
+    with sqlite3.connect(shared_dir / "shared.db") as conn:
+        owner = conn.execute(
+            "SELECT n.name FROM subdomains s JOIN names n ON n.ID=s.program_ID WHERE s.subdomain=?;", (shared[0],)
+        ).fetchone()[0]
+    write_shared_dataset(shared_dir / "www", port, shared, dropped=owner)
+    started = time.perf_counter()
+    sync()
+    record(stages, "shared_names", time.perf_counter() - started, len(shared))
+    server.shutdown()
+    with sqlite3.connect(shared_dir / "shared.db") as conn:
+        current = conn.execute(
+            "SELECT count(*) FROM subdomains WHERE subdomain LIKE '%.shared.example' AND removed IS NULL;"
+        ).fetchone()[0]
+    if current != len(shared):
+        raise SystemExit(f"{len(shared) - current} of {len(shared)} shared subdomains were removed when only {owner} dropped them")
+
+def sync_worker():
+    # Entry point of the shard processes started by run_sharded()
+    cd = load_downloader()
+    cd.download_programs(cd.get_catalog().programs, SAVE_DIR, probe_tool="", interactive=False)
+    cd.get_db_writer().close()
+
+##########################################
+# Reporting and regression gate
+##########################################
+def compare(result, baseline, max_regression):
+    # Returns the stages that got slower than the allowed ratio
+    rows, regressions = [], []
+    for stage, current in result["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if not previous or not previous["seconds"]:
+            continue
+        ratio = current["seconds"] / previous["seconds"]
+        rows.append([stage, previous["seconds"], current["seconds"], f"{ratio:.2f}x"])
+        if ratio > 1 + max_regression:
+            regressions.append(stage)
+    print(tabulate(rows, headers=["stage", "baseline s", "current s", "ratio"], tablefmt="double_grid"))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for chaos-downloader.py")
+    parser.add_argument("--programs", type=int, default=50, help="number of synthetic programs")
+    parser.add_argument("--lines", type=int, default=20000, help="subdomains per program")
+    parser.add_argument("--files", type=int, default=4, help="root domains (zip members) per program")
+    parser.add_argument("--workers", type=int, default=5, help="CHAOS_WORKERS for the run")
+    parser.add_argument("--changed-ratio", type=float, default=0.1, help="share of programs changed for the second run")
+    parser.add_argument("--output", default="bench_output.json", help="where to write the JSON results")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed slowdown per stage with --compare")
+    parser.add_argument("--shards", type=int, default=0, help="also sync with this many CHAOS_SHARD processes and merge them")
+    parser.add_argument("--sync-worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.sync_worker:
+        sync_worker()
+        return
+
+    output = Path(args.output).resolve()
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+    with tempfile.TemporaryDirectory(prefix="chaos-bench-") as workdir:
+        cwd = os.getcwd()
+        try:
+            result = run_benchmark(args, Path(workdir))
+        finally:
+            os.chdir(cwd)
+
+    output.write_text(json.dumps(result, indent=2))
+    print(tabulate(
+        [[stage, r["seconds"], r["items"], r["items_per_sec"], r["mb_per_sec"], r["peak_rss_mb"]]
+         for stage, r in result["stages"].items()],
+        headers=["stage", "seconds", "items", "items/s", "MB/s", "peak RSS MB"],
+        tablefmt="double_grid"
+    ))
+    print(f"{result['subdomains']} subdomains, DB {result['db_size_mb']} MB, peak RSS {result['peak_rss_mb']} MB -> {output}")
+    if baseline and compare(result, baseline, args.max_regression):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,266 +1,1918 @@
 #!/usr/bin/env python3
 import os
-import urllib.request
+import re
+import argparse
+import atexit
+import queue
+import time
+import socket
+import contextlib
 import urllib.parse
+import urllib.error
+import io
+import gzip
+import heapq
+import zlib
+import hashlib
+import shutil
+import mmap
+import struct
+import tempfile
+import csv
 import json
 import zipfile
-import glob
+import itertools
+import collections
+import random
 import subprocess
+import cProfile
+import resource
 import sqlite3
 import threading
+import multiprocessing
 import concurrent.futures
 from pathlib import Path
-from simple_term_menu import TerminalMenu
-from tabulate import tabulate
 
-# Clear screen
-os.system("clear")
+##########################################
+# Colors for terminal output
+##########################################
+Red     = "\033[31m"
+Green   = "\033[32m"
+White   = "\033[97m"
+Yellow  = "\033[33m"
+Default = "\033[0m"
+
+##########################################
+# Settings (override with environment variables)
+##########################################
+# "i/N" runs only shard i (1..N) of the programs, with its own database and output files
+SHARD = os.environ.get("CHAOS_SHARD", "")
+try:
+    SHARD_INDEX, SHARD_COUNT = (int(part) for part in SHARD.split("/")) if SHARD else (1, 1)
+except ValueError:
+    SHARD_INDEX = SHARD_COUNT = 0
+if not 1 <= SHARD_INDEX <= SHARD_COUNT:
+    raise SystemExit(f"CHAOS_SHARD={SHARD}: expected i/N with 1 <= i <= N")
+SHARD_SUFFIX = f"_shard{SHARD_INDEX}of{SHARD_COUNT}" if SHARD else ""
+
+DB_PATH = os.environ.get("CHAOS_DB", f"chaos{SHARD_SUFFIX}.db")
+
+# Applied to every SQLite connection; WAL lets readers run while the writer commits
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("CHAOS_SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous":  os.environ.get("CHAOS_SQLITE_SYNCHRONOUS", "NORMAL"),
+    "cache_size":   os.environ.get("CHAOS_SQLITE_CACHE_SIZE", "-65536"),      # negative = KiB
+    "mmap_size":    os.environ.get("CHAOS_SQLITE_MMAP_SIZE", "268435456"),
+    "busy_timeout": os.environ.get("CHAOS_SQLITE_BUSY_TIMEOUT", "30000"),     # ms
+}
+WRITER_QUEUE_SIZE = int(os.environ.get("CHAOS_WRITER_QUEUE_SIZE", "64"))    # pending write operations
+WRITER_BATCH_OPS  = int(os.environ.get("CHAOS_WRITER_BATCH_OPS", "256"))    # operations per transaction
+
+DOWNLOAD_WORKERS = int(os.environ.get("CHAOS_WORKERS", "5"))                 # concurrent program downloads
+SCHEDULE         = os.environ.get("CHAOS_SCHEDULE", "largest")               # index, largest or changed first
+RUN_DEADLINE     = float(os.environ.get("CHAOS_DEADLINE", "0"))              # seconds before no new program starts, 0 = none
+BYTE_BUDGET      = int(os.environ.get("CHAOS_BYTE_BUDGET", "0"))             # bytes downloaded before no new program starts, 0 = none
+HTTP_TIMEOUT     = float(os.environ.get("CHAOS_HTTP_TIMEOUT", "60"))         # seconds per socket operation
+BANDWIDTH_LIMIT  = int(os.environ.get("CHAOS_BANDWIDTH_LIMIT", "0"))         # bytes/s for all downloads, 0 = no cap
+
+DOWNLOAD_DIR     = Path(os.environ.get("CHAOS_DOWNLOAD_DIR", ".chaos-downloads"))  # .part files live here
+DOWNLOAD_RETRIES = int(os.environ.get("CHAOS_RETRIES", "5"))
+RETRY_BASE_DELAY = float(os.environ.get("CHAOS_RETRY_BASE_DELAY", "1"))      # seconds, doubled per attempt
+RETRY_MAX_DELAY  = float(os.environ.get("CHAOS_RETRY_MAX_DELAY", "60"))
+
+SORT_MEMORY_LIMIT = int(os.environ.get("CHAOS_SORT_MEMORY", str(256 * 1024 * 1024)))  # bytes per in-memory sort run
+MERGE_FAN_IN      = int(os.environ.get("CHAOS_MERGE_FAN_IN", "64"))          # run files merged at once
+MASTER_GZIP       = os.environ.get("CHAOS_MASTER_GZIP", "0") == "1"          # write <dir>.txt.gz instead of <dir>.txt
+MASTER_FILES      = os.environ.get("CHAOS_MASTER_FILES", "1") == "1"         # 0 = no <dir>.txt copies, read views from the store
+
+STORE_DIR         = os.environ.get("CHAOS_STORE", "chaos-store")             # downloaded zips kept by content hash, "" = delete them
+
+EXPORT_WORKERS    = int(os.environ.get("CHAOS_EXPORT_WORKERS", "4"))         # programs exported concurrently
+
+STREAM_PROBE      = os.environ.get("CHAOS_STREAM_PROBE", "")                 # httprobe/httpx/builtin: probe while downloading
+PROBE_QUEUE_SIZE  = int(os.environ.get("CHAOS_PROBE_QUEUE_SIZE", "16"))      # batches waiting for the prober
+PROBE_CONCURRENCY = int(os.environ.get("CHAOS_PROBE_CONCURRENCY", "200"))    # hosts probed at once by the built-in prober
+PROBE_TIMEOUT     = float(os.environ.get("CHAOS_PROBE_TIMEOUT", "10"))       # seconds per DNS lookup, connect or read
+PROBE_HOST_RATE   = float(os.environ.get("CHAOS_PROBE_HOST_RATE", "10"))     # connections/s per IP address, 0 = no limit
+
+METRICS_JSON      = os.environ.get("CHAOS_METRICS_JSON", "")                 # run summary path, "" = off
+METRICS_PROM      = os.environ.get("CHAOS_METRICS_PROM", "")                 # Prometheus textfile path, "" = off
+PROFILE_PATH      = os.environ.get("CHAOS_PROFILE", "")                      # cProfile stats of the download tasks, "" = off
+
+BLOOM_PATH        = os.environ.get("CHAOS_BLOOM", f"{DB_PATH}.bloom")      # known-subdomain filter file, "" = off
+NORMALIZE_WORKERS = int(os.environ.get("CHAOS_NORMALIZE_WORKERS", str(os.cpu_count() or 1)))  # processes, 0 = in the download threads
+
+##########################################
+# Run metrics and profiling
+##########################################
+class Metrics:
+    """Stage timers, counters and gauges for this process.
+
+    Stages add up busy seconds, items and bytes from every thread, so a
+    stage's seconds can exceed the wall time of the run. Gauges keep the
+    highest value observed. The JSON summary and the Prometheus textfile
+    are both written from this data by write().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = collections.defaultdict(lambda: {"seconds": 0.0, "count": 0, "items": 0, "bytes": 0})
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.programs = []
+        self.profile = None
+
+    def record(self, stage, seconds, items=0, nbytes=0):
+        with self.lock:
+            totals = self.stages[stage]
+            totals["seconds"] += seconds
+            totals["count"] += 1
+            totals["items"] += items
+            totals["bytes"] += nbytes
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        # The caller may fill in "items" and "bytes" on the yielded dict
+        stats = {"items": 0, "bytes": 0}
+        started = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            self.record(stage, time.perf_counter() - started, stats["items"], stats["bytes"])
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.gauges[name] = max(value, self.gauges.get(name, value))
+
+    def program(self, name, **fields):
+        with self.lock:
+            self.programs.append({"name": name, **fields})
+
+    def add_profile(self, profile):
+        import pstats  # slow to import and only used with CHAOS_PROFILE
+        with self.lock:
+            if self.profile is None:
+                self.profile = pstats.Stats(profile)
+            else:
+                self.profile.add(profile)
+
+    def summary(self):
+        with self.lock:
+            stages = {}
+            for stage, totals in self.stages.items():
+                seconds = totals["seconds"]
+                stages[stage] = dict(
+                    totals,
+                    seconds=round(seconds, 4),
+                    items_per_sec=round(totals["items"] / seconds, 1) if seconds and totals["items"] else None,
+                    mb_per_sec=round(totals["bytes"] / seconds / 1048576, 2) if seconds and totals["bytes"] else None,
+                )
+            return {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started)),
+                "wall_seconds": round(time.time() - self.started, 2),
+                "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+                "stages": stages,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "programs": list(self.programs),
+            }
+
+    def prometheus(self, summary):
+        lines = [
+            "# TYPE chaos_run_started_timestamp_seconds gauge",
+            f"chaos_run_started_timestamp_seconds {self.started:.0f}",
+            "# TYPE chaos_peak_rss_bytes gauge",
+            f"chaos_peak_rss_bytes {summary['peak_rss_mb'] * 1048576:.0f}",
+        ]
+        for field in ("seconds", "items", "bytes"):
+            lines.append(f"# TYPE chaos_stage_{field}_total counter")
+            for stage, totals in summary["stages"].items():
+                lines.append(f'chaos_stage_{field}_total{{stage="{stage}"}} {totals[field]}')
+        for name, value in summary["counters"].items():
+            lines += [f"# TYPE chaos_{name}_total counter", f"chaos_{name}_total {value}"]
+        for name, value in summary["gauges"].items():
+            lines += [f"# TYPE chaos_{name}_max gauge", f"chaos_{name}_max {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        # Files are replaced atomically so a textfile collector never reads a partial file
+        summary = self.summary()
+        outputs = [(METRICS_JSON, lambda: json.dumps(summary, indent=2)), (METRICS_PROM, lambda: self.prometheus(summary))]
+        for path, render in outputs:
+            if path:
+                tmp_path = f"{path}.tmp"
+                Path(tmp_path).write_text(render())
+                os.replace(tmp_path, path)
+        with self.lock:
+            if PROFILE_PATH and self.profile is not None:
+                self.profile.dump_stats(PROFILE_PATH)
+        return summary
+
+def run_profiled(func, *args):
+    # With CHAOS_PROFILE set, every task gets its own profiler whose stats are merged afterwards
+    if not PROFILE_PATH:
+        return func(*args)
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Python 3.12+ allows only one active profiler; this task runs unprofiled
+        return func(*args)
+    try:
+        return func(*args)
+    finally:
+        profile.disable()
+        metrics.add_profile(profile)
+
+metrics = Metrics()
+
+##########################################
+# Subdomain normalization
+##########################################
+# Letters, digits, "-" and "_" (for names like _dmarc); labels of at most 63 characters
+HOSTNAME_RE = re.compile(r"(?:[a-z0-9_](?:[a-z0-9_-]{0,61}[a-z0-9_])?\.)+[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?")
+
+def normalize_subdomain(line):
+    # Returns the canonical lowercase ASCII form, or None for lines that are not a hostname
+    name = line.strip().lower().rstrip(".")
+    while name.startswith("*."):
+        name = name[2:]
+    if not name.isascii():
+        try:
+            name = name.encode("idna").decode("ascii")
+        except UnicodeError:
+            return None
+    if len(name) > 253 or not HOSTNAME_RE.fullmatch(name):
+        return None
+    return name
+
+# Second-level labels that are registries of their own under a two-letter ccTLD (example.co.uk, example.com.au)
+SECOND_LEVEL_LABELS = {"ac", "co", "com", "edu", "gob", "gov", "go", "ltd", "mil", "ne", "net", "or", "org", "plc"}
+
+def reverse_labels(name):
+    # "www.example.com" -> "com.example.www."; the domain and all names under it share the prefix "com.example."
+    return ".".join(name.split(".")[::-1]) + "."
+
+def is_public_suffix(name):
+    # co.uk, com.au, ...: names under it belong to different registrants
+    labels = name.split(".")
+    return len(labels) == 2 and len(labels[1]) == 2 and labels[0] in SECOND_LEVEL_LABELS
+
+def apex_domain(name):
+    # Registrable domain by a short heuristic rather than the full public suffix list.
+    # A bare public suffix stored as a name is returned as itself; see is_public_suffix().
+    labels = name.rsplit(".", 3)
+    if len(labels) >= 3 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_LABELS:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+def normalize_chunk(lines):
+    # Returns (unique normalized names in input order, number of rejected lines)
+    clean = {}
+    rejected = 0
+    for line in lines:
+        name = normalize_subdomain(line)
+        if name is None:
+            rejected += 1
+        else:
+            clean[name] = None
+    return list(clean), rejected
+
+normalize_pool = None
+normalize_pool_lock = threading.Lock()
+
+def get_normalize_pool():
+    # Forked workers share the already imported module, so nothing is re-run in them
+    global normalize_pool
+    if NORMALIZE_WORKERS < 1:
+        return None
+    with normalize_pool_lock:
+        if normalize_pool is None:
+            get_known_filter()  # opened before the fork so the workers share the mapping
+            normalize_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=NORMALIZE_WORKERS, mp_context=multiprocessing.get_context("fork")
+            )
+            # With fork all workers start on the first submit; do that now rather than mid-download
+            normalize_pool.submit(int).result()
+            atexit.register(normalize_pool.shutdown)
+    return normalize_pool
+
+def prepare_chunk(lines):
+    # Returns (names that may be stored already, names that are certainly new, rejected line count)
+    clean, rejected = normalize_chunk(lines)
+    known = get_known_filter()
+    if known is None:
+        return clean, [], rejected
+    maybe, new = known.split(clean, add=True)
+    # Key order makes the inserts appends to the subdomains B-tree, like the names coming out of staging
+    new.sort()
+    return maybe, new, rejected
+
+def prepare_async(lines):
+    # Returns a Future of prepare_chunk(lines)
+    pool = get_normalize_pool()
+    if pool is not None:
+        return pool.submit(prepare_chunk, lines)
+    future = concurrent.futures.Future()
+    future.set_result(prepare_chunk(lines))
+    return future
 
 ##########################################
 # Database setup with thread safety
 ##########################################
-sqliteConnection = sqlite3.connect('chaos.db', check_same_thread=False)
-cursor = sqliteConnection.cursor()
+# INSERT ... RETURNING in the writer path; the diffs and batches also need the JSON1 functions
+SQLITE_MIN_VERSION = (3, 35, 0)
+
+def check_sqlite(conn):
+    if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+        raise SystemExit(
+            f"SQLite {sqlite3.sqlite_version} is too old: chaos-downloader needs "
+            f"{'.'.join(map(str, SQLITE_MIN_VERSION))} or newer (use a Python built against a newer SQLite)"
+        )
+    try:
+        conn.execute("SELECT json_valid('[]');")
+    except sqlite3.OperationalError:
+        raise SystemExit(f"SQLite {sqlite3.sqlite_version} lacks the JSON1 functions chaos-downloader needs")
+
+def connect_db(path=DB_PATH):
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    for pragma, value in SQLITE_PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma}={value};")
+    # Used by the inserts into subdomains to fill rname
+    conn.create_function("reverse_labels", 1, reverse_labels, deterministic=True)
+    return conn
+
+# Opened by get_db_writer()
+sqliteConnection = None
+cursor = None
 sqlite_lock = threading.Lock()
+output_lock = threading.Lock()
+thread_local = threading.local()
+
+def migrate_v1(cur):
+    # Original layout; IF NOT EXISTS keeps databases created before versioning intact
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS names (ID INTEGER PRIMARY KEY, name TEXT UNIQUE, platform TEXT, offer_bounty BOOLEAN, late_update DATE);"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS subdomains (ID INTEGER PRIMARY KEY, subdomain TEXT UNIQUE, program_ID INTEGER, FOREIGN KEY(program_ID) REFERENCES names(ID));"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS http_cache (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, last_updated TEXT, body BLOB);"
+    )
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS failed_downloads (name TEXT PRIMARY KEY, save_dir TEXT, error TEXT, attempts INTEGER, failed_at DATETIME);"
+    )
+
+def migrate_v2(cur):
+    # Drop the unused rowid/ID and the separate UNIQUE index: the subdomain is the key itself.
+    # The program index makes per-program exports and diffs a range scan instead of a full scan.
+    cur.execute(
+        "CREATE TABLE subdomains_v2 (subdomain TEXT PRIMARY KEY, program_ID INTEGER, FOREIGN KEY(program_ID) REFERENCES names(ID)) WITHOUT ROWID;"
+    )
+    cur.execute(
+        "INSERT OR IGNORE INTO subdomains_v2(subdomain, program_ID) "
+        "SELECT subdomain, program_ID FROM subdomains WHERE subdomain IS NOT NULL ORDER BY subdomain;"
+    )
+    cur.execute("DROP TABLE subdomains;")
+    cur.execute("ALTER TABLE subdomains_v2 RENAME TO subdomains;")
+    cur.execute("CREATE INDEX subdomains_program ON subdomains(program_ID);")
+
+def migrate_v3(cur):
+    # Liveness results of the built-in prober
+    cur.execute(
+        "CREATE TABLE probes (subdomain TEXT PRIMARY KEY, url TEXT, status INTEGER, probed_at DATETIME) WITHOUT ROWID;"
+    )
+
+def migrate_v4(cur):
+    # Older versions stored lines as-is: fold case variants, wildcards and IDN names, drop junk
+    changes = [
+        (subdomain, program_id, normalize_subdomain(subdomain))
+        for subdomain, program_id in cur.execute("SELECT subdomain, program_ID FROM subdomains;")
+        if normalize_subdomain(subdomain) != subdomain
+    ]
+    for subdomain, program_id, name in changes:
+        cur.execute("DELETE FROM subdomains WHERE subdomain=?;", (subdomain,))
+        if name is not None:
+            cur.execute("INSERT OR IGNORE INTO subdomains(subdomain, program_ID) VALUES(?, ?);", (name, program_id))
+
+def migrate_v5(cur):
+    # Run history. first_seen/removed hold run IDs; first_seen is NULL for names stored before this version.
+    # last_seen is derived from the runs that saw the program, so unchanged names are never rewritten.
+    cur.execute(
+        "CREATE TABLE runs (ID INTEGER PRIMARY KEY, save_dir TEXT, started_at DATETIME, finished_at DATETIME, "
+        "programs INTEGER, added INTEGER, removed INTEGER);"
+    )
+    cur.execute(
+        "CREATE TABLE program_runs (program_ID INTEGER, run_ID INTEGER, PRIMARY KEY(program_ID, run_ID)) WITHOUT ROWID;"
+    )
+    cur.execute(
+        "CREATE TABLE subdomain_events (subdomain TEXT, run_ID INTEGER, added BOOLEAN, PRIMARY KEY(subdomain, run_ID)) WITHOUT ROWID;"
+    )
+    cur.execute("CREATE INDEX subdomain_events_run ON subdomain_events(run_ID);")
+    cur.execute("ALTER TABLE subdomains ADD COLUMN first_seen INTEGER;")
+    cur.execute("ALTER TABLE subdomains ADD COLUMN removed INTEGER;")
+    cur.execute(
+        "CREATE VIEW subdomain_history AS SELECT s.subdomain, n.name AS program, s.first_seen, "
+        "(SELECT max(p.run_ID) FROM program_runs p WHERE p.program_ID=s.program_ID "
+        "AND (s.removed IS NULL OR p.run_ID < s.removed)) AS last_seen, s.removed "
+        "FROM subdomains s LEFT JOIN names n ON n.ID=s.program_ID;"
+    )
+
+def migrate_v6(cur):
+    # Reversed labels make "every name under example.com" an index range scan instead of a LIKE '%.example.com' scan
+    cur.execute("ALTER TABLE subdomains ADD COLUMN rname TEXT;")
+    cur.execute("UPDATE subdomains SET rname=reverse_labels(subdomain);")
+    # Covers suffix listings, ownership and per-apex counts (the subdomain is the key, so every index holds it)
+    cur.execute("CREATE INDEX subdomains_rname ON subdomains(rname, program_ID, removed);")
+
+def migrate_v7(cur):
+    # Programs that list a subdomain another program owns. A name only counts as removed once no program
+    # lists it; until then ownership moves on. Filled as programs are downloaded (sync --force fills it at once).
+    cur.execute(
+        "CREATE TABLE shared_subdomains (subdomain TEXT, program_ID INTEGER, PRIMARY KEY(subdomain, program_ID)) WITHOUT ROWID;"
+    )
+    cur.execute("CREATE INDEX shared_subdomains_program ON shared_subdomains(program_ID);")
+
+def migrate_v8(cur):
+    # The version (index last_updated) of each program's list that went into <dir>.txt. The HTTP cache is per URL,
+    # so without it a program skipped as unchanged never reaches the master file of another directory.
+    # Empty at first: the next run adds every unchanged program's names from chaos.db once.
+    cur.execute(
+        "CREATE TABLE program_outputs (name TEXT, save_dir TEXT, last_updated TEXT, PRIMARY KEY(name, save_dir)) WITHOUT ROWID;"
+    )
+
+# MIGRATIONS[n] upgrades the schema to version n + 1 (stored in PRAGMA user_version)
+MIGRATIONS = [migrate_v1, migrate_v2, migrate_v3, migrate_v4, migrate_v5, migrate_v6, migrate_v7, migrate_v8]
 
 def setup_database():
     with sqlite_lock:
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS names (ID INTEGER PRIMARY KEY, name TEXT UNIQUE, platform TEXT, offer_bounty BOOLEAN, late_update DATE);"
-        )
-        cursor.execute(
-            "CREATE TABLE IF NOT EXISTS subdomains (ID INTEGER PRIMARY KEY, subdomain TEXT UNIQUE, program_ID INTEGER, FOREIGN KEY(program_ID) REFERENCES names(ID));"
+        version = cursor.execute("PRAGMA user_version;").fetchone()[0]
+        if version >= len(MIGRATIONS):
+            return
+        existing = cursor.execute("SELECT 1 FROM sqlite_master WHERE name='subdomains';").fetchone()
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            if existing:
+                print(f"{Yellow}[*]{White} Migrating {DB_PATH} to schema v{number}...")
+            cursor.execute("BEGIN IMMEDIATE;")
+            migration(cursor)
+            cursor.execute(f"PRAGMA user_version={number};")
+            cursor.execute("COMMIT;")
+        cursor.execute("ANALYZE;")
+        free_pages = cursor.execute("PRAGMA freelist_count;").fetchone()[0]
+        total_pages = cursor.execute("PRAGMA page_count;").fetchone()[0]
+    if existing and free_pages > total_pages // 10:
+        # Rebuilt tables leave free pages behind; give the space back once
+        maintain_database(vacuum=True)
+
+def maintain_database(vacuum=False):
+    # Refresh planner statistics and optionally compact the file; returns (size before, size after)
+    get_db_writer()
+    size_before = os.path.getsize(DB_PATH)
+    with sqlite_lock:
+        cursor.execute("ANALYZE;")
+        cursor.execute("PRAGMA optimize;")
+        if vacuum:
+            cursor.execute("VACUUM;")
+        cursor.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    return size_before, os.path.getsize(DB_PATH)
+
+def get_connection():
+    # One read connection per thread; its private temp schema holds the staging table
+    conn = getattr(thread_local, "conn", None)
+    if conn is None:
+        get_db_writer()  # creates or migrates chaos.db first
+        conn = connect_db()
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS staging (subdomain TEXT PRIMARY KEY) WITHOUT ROWID;"
         )
-        sqliteConnection.commit()
+        thread_local.conn = conn
+    return conn
+
+class DatabaseWriter(threading.Thread):
+    """Single thread that owns the write connection.
+
+    Other threads hand it callables through a bounded queue and get a
+    Future back. Queued operations are applied in large transactions, each
+    one inside its own savepoint so a failing operation does not roll back
+    the rest of the batch.
+    """
+
+    def __init__(self, path=DB_PATH, queue_size=WRITER_QUEUE_SIZE, batch_ops=WRITER_BATCH_OPS):
+        super().__init__(name="chaos-db-writer", daemon=True)
+        self.path = path
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_ops = batch_ops
+
+    def submit(self, func, *args):
+        # func(conn, *args) runs on the writer thread; blocks while the queue is full
+        future = concurrent.futures.Future()
+        self.queue.put((func, args, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+    def run(self):
+        conn = connect_db(self.path)
+        running = True
+        while running:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.batch_ops:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self.apply(conn, batch)
+        conn.execute("PRAGMA optimize;")
+        conn.close()
 
-setup_database()
+    def apply(self, conn, batch):
+        # Time from submit() to here is what callers spend waiting for the single writer
+        started = time.perf_counter()
+        metrics.record("db_write_wait", sum(started - enqueued for *_, enqueued in batch), len(batch))
+        metrics.observe("writer_queue_depth", self.queue.qsize() + len(batch))
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            for func, args, future, _ in batch:
+                conn.execute("SAVEPOINT op;")
+                try:
+                    results.append((future, func(conn, *args), None))
+                    conn.execute("RELEASE op;")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO op;")
+                    conn.execute("RELEASE op;")
+                    results.append((future, None, e))
+            conn.execute("COMMIT;")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK;")
+            results = [(future, None, e) for _, _, future, _ in batch]
+        metrics.record("db_write", time.perf_counter() - started, len(batch))
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+db_writer = None
+# Re-entrant: setup_database() may run maintain_database()
+database_lock = threading.RLock()
+
+def get_db_writer():
+    # chaos.db is opened, migrated and given its writer thread on first use, not at import
+    global sqliteConnection, cursor, db_writer
+    with database_lock:
+        if db_writer is None and sqliteConnection is None:
+            sqliteConnection = connect_db()
+            check_sqlite(sqliteConnection)
+            cursor = sqliteConnection.cursor()
+            setup_database()
+            db_writer = DatabaseWriter()
+            db_writer.start()
+            atexit.register(db_writer.close)
+    return db_writer
 
 ##########################################
-# Colors for terminal output
+# HTTP connection pool and bandwidth cap
 ##########################################
-Red     = "\033[31m"
-Green   = "\033[32m"
-White   = "\033[97m"
-Yellow  = "\033[33m"
-Default = "\033[0m"
+def import_network_modules():
+    # Importing these takes longer than a quick database query, so only commands that go online pay for it
+    global asyncio, http, ssl
+    import asyncio
+    import http.client
+    import ssl
+
+class RateLimiter:
+    """Token bucket shared by all download threads to cap total bandwidth."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= amount
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections shared by the download threads.
+
+    Idle connections are kept per host so every zip after the first one
+    reuses an established TLS session instead of doing a new handshake.
+    """
+
+    def __init__(self, max_idle=DOWNLOAD_WORKERS, timeout=HTTP_TIMEOUT):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        self.ssl_context = None
+
+    def connect(self, scheme, netloc):
+        if scheme == "https":
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout, context=self.ssl_context)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def acquire(self, scheme, netloc):
+        # Returns (connection, reused)
+        with self.lock:
+            if self.idle[(scheme, netloc)]:
+                return self.idle[(scheme, netloc)].pop(), True
+        return self.connect(scheme, netloc), False
+
+    def release(self, scheme, netloc, conn, response):
+        # Only a fully read response on a persistent connection can be reused
+        if response.isclosed() and not response.will_close:
+            with self.lock:
+                if len(self.idle[(scheme, netloc)]) < self.max_idle:
+                    self.idle[(scheme, netloc)].append(conn)
+                    return
+        conn.close()
+
+    @contextlib.contextmanager
+    def open(self, url, headers, max_redirects=5):
+        # Yields an http.client.HTTPResponse; raises urllib.error.HTTPError for 4xx/5xx
+        import_network_modules()
+        for _ in range(max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+            conn, reused = self.acquire(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                # The server dropped an idle keep-alive connection; retry on a fresh one
+                conn = self.connect(parts.scheme, parts.netloc)
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+            if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                response.read()
+                self.release(parts.scheme, parts.netloc, conn, response)
+                url = urllib.parse.urljoin(url, response.getheader("Location"))
+                continue
+            try:
+                if response.status >= 400:
+                    raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+                yield response
+            finally:
+                if not response.isclosed():
+                    # Drain small bodies (errors, 304) so the connection stays reusable
+                    if response.length is not None and response.length <= 65536:
+                        response.read()
+                    else:
+                        response.close()
+                self.release(parts.scheme, parts.netloc, conn, response)
+            return
+        raise urllib.error.HTTPError(url, 310, "Too many redirects", None, None)
+
+def copy_response(response, file, block_size=64 * 1024):
+    # Returns the number of bytes written
+    total = 0
+    while block := response.read(block_size):
+        bandwidth_limiter.consume(len(block))
+        file.write(block)
+        total += len(block)
+    return total
+
+http_pool = ConnectionPool()
+bandwidth_limiter = RateLimiter(BANDWIDTH_LIMIT)
+
+##########################################
+# HTTP cache (ETag / Last-Modified per URL)
+##########################################
+INDEX_URL = os.environ.get("CHAOS_INDEX_URL", "https://chaos-data.projectdiscovery.io/index.json")
+
+# Returned by download() when the server answers 304 Not Modified
+NOT_MODIFIED = "not modified"
+
+def get_cache_entry(url):
+    return get_connection().execute(
+        "SELECT etag, last_modified, last_updated, body FROM http_cache WHERE url=?", (url,)
+    ).fetchone()
+
+def update_cache_entry(url, etag, last_modified, last_updated=None, body=None):
+    return get_db_writer().submit(
+        lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO http_cache(url, etag, last_modified, last_updated, body) VALUES(?, ?, ?, ?, ?);",
+            (url, etag, last_modified, last_updated, body)
+        )
+    )
+
+def request_headers(cache_entry=None):
+    # Custom User-Agent to avoid 403 errors, plus validators for a conditional request
+    headers = {"User-Agent": "Mozilla/5.0"}
+    if cache_entry:
+        etag, last_modified = cache_entry[0], cache_entry[1]
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    return headers
 
 ##########################################
 # Load JSON data from chaos API
 ##########################################
 def load_data():
-    url = "https://chaos-data.projectdiscovery.io/index.json"
-    req = urllib.request.Request(url, headers={"User-Agent": "Mozilla/5.0"})
-    webpage = urllib.request.urlopen(req).read()
+    entry = get_cache_entry(INDEX_URL)
+    if entry and entry[3] is None:
+        entry = None
+    with metrics.timer("index") as stats:
+        with http_pool.open(INDEX_URL, request_headers(entry)) as response:
+            if response.status == 304 and entry:
+                return json.loads(entry[3])
+            webpage = response.read()
+            etag, last_modified = response.getheader("ETag"), response.getheader("Last-Modified")
+        stats["bytes"] = len(webpage)
+    update_cache_entry(INDEX_URL, etag, last_modified, body=webpage)
     return json.loads(webpage)
 
-data_json = load_data()
+##########################################
+# Program catalog with prebuilt indexes
+##########################################
+class ProgramCatalog:
+    """Programs from index.json with lookup indexes built in one pass.
+
+    Indexes map to positions in index order, so select() intersects the
+    smallest matching sets and returns programs in the order of the index.
+    Query expressions join terms with "&"; a term is a flag (bounty,
+    changed, new, swag), platform=<name> (empty for self hosted) or
+    name=<a,b,...>, optionally negated with "!":
+
+        catalog.select("platform=hackerone&bounty&changed")
+    """
+
+    FLAGS = ("bounty", "changed", "new", "swag")
+
+    def __init__(self, programs):
+        self.programs = list(programs)
+        self.by_name = {}
+        self.by_platform = collections.defaultdict(set)
+        self.by_flag = {flag: set() for flag in self.FLAGS}
+        stats = collections.Counter()
+        last_update = ""
+        for position, p in enumerate(self.programs):
+            platform = p["platform"].lower()
+            self.by_name[p["name"]] = position
+            self.by_platform[platform].add(position)
+            flags = {
+                "bounty": p["bounty"] == True,
+                "changed": p["change"] != 0,
+                "new": p["is_new"] == True,
+                "swag": "swag" in p,
+            }
+            for flag, is_set in flags.items():
+                if is_set:
+                    self.by_flag[flag].add(position)
+                    stats[flag] += 1
+            stats["subdomains"] += p["count"]
+            stats[f"platform:{platform}"] += 1
+            last_update = max(last_update, p["last_updated"][:10])
+        self.stats = {
+            "last_update": last_update,
+            "programs": len(self.programs),
+            "subdomains": stats["subdomains"],
+            "changed": stats["changed"],
+            "new": stats["new"],
+            "hackerone": stats["platform:hackerone"],
+            "bugcrowd": stats["platform:bugcrowd"],
+            "yeswehack": stats["platform:yeswehack"],
+            "self_hosted": stats["platform:"],
+            "bounty": stats["bounty"],
+            "no_bounty": len(self.programs) - stats["bounty"],
+            "swag": stats["swag"],
+        }
+
+    def get(self, name):
+        position = self.by_name.get(name)
+        return None if position is None else self.programs[position]
 
-# Set up an opener with a custom header (to avoid 403 errors)
-opener = urllib.request.URLopener()
-opener.addheader('User-Agent', 'Mozilla/5.0')
+    def names(self):
+        return [p["name"] for p in self.programs]
+
+    def term_positions(self, term):
+        key, _, value = term.partition("=")
+        key = key.strip().lower()
+        if key in self.by_flag and not _:
+            return self.by_flag[key]
+        if key == "platform":
+            value = value.strip().lower()
+            return self.by_platform.get("" if value in ("self hosted", "self_hosted") else value, set())
+        if key == "name":
+            return {self.by_name[n] for n in value.split(",") if n in self.by_name}
+        raise ValueError(f"Unknown filter term: {term!r}")
+
+    def select(self, expression=""):
+        include, exclude = [], []
+        for term in filter(None, (t.strip() for t in expression.split("&"))):
+            if term.lower() == "all":
+                continue
+            if term.startswith("!"):
+                exclude.append(self.term_positions(term[1:]))
+            else:
+                include.append(self.term_positions(term))
+        if include:
+            include.sort(key=len)
+            positions = include[0].intersection(*include[1:])
+        else:
+            positions = range(len(self.programs))
+        if exclude:
+            positions = [i for i in positions if not any(i in e for e in exclude)]
+        return [self.programs[i] for i in sorted(positions)]
+
+catalog = None
+catalog_lock = threading.Lock()
+
+def get_catalog():
+    # index.json is only fetched by commands that need the program list
+    global catalog
+    with catalog_lock:
+        if catalog is None:
+            catalog = ProgramCatalog(load_data())
+    return catalog
 
 ##########################################
 # Helper functions for database operations
 ##########################################
 def insert_table_name(program_name, platform, offer_bounty):
-    with sqlite_lock:
-        try:
-            cursor.execute(
-                "INSERT OR IGNORE INTO names(name, platform, offer_bounty, late_update) VALUES(?, ?, ?, DATE('NOW'));",
-                (program_name, platform, offer_bounty)
-            )
-            sqliteConnection.commit()
-        except Exception as e:
-            print("DB error:", e)
+    # Returns the program ID
+    def insert(conn):
+        conn.execute(
+            "INSERT OR IGNORE INTO names(name, platform, offer_bounty, late_update) VALUES(?, ?, ?, DATE('NOW'));",
+            (program_name, platform, offer_bounty)
+        )
+        return conn.execute("SELECT ID FROM names WHERE name=?", (program_name,)).fetchone()[0]
+    return get_db_writer().submit(insert).result()
 
-def insert_domains(program_name, subdomain):
-    with sqlite_lock:
-        try:
-            cursor.execute("SELECT ID FROM names WHERE name=?", (program_name,))
-            row = cursor.fetchone()
-            if row:
-                program_id = row[0]
-                cursor.execute(
-                    "INSERT OR IGNORE INTO subdomains(subdomain, program_ID) VALUES(?, ?)",
-                    (subdomain, program_id)
-                )
-                sqliteConnection.commit()
-        except sqlite3.IntegrityError:
-            pass
+def record_failed_download(program_name, save_dir, error):
+    return get_db_writer().submit(
+        lambda conn: conn.execute(
+            "INSERT INTO failed_downloads(name, save_dir, error, attempts, failed_at) VALUES(?, ?, ?, 1, DATETIME('NOW')) "
+            "ON CONFLICT(name) DO UPDATE SET save_dir=excluded.save_dir, error=excluded.error, "
+            "attempts=attempts+1, failed_at=excluded.failed_at;",
+            (program_name, save_dir, str(error))
+        )
+    )
+
+def clear_failed_download(program_name):
+    return get_db_writer().submit(
+        lambda conn: conn.execute("DELETE FROM failed_downloads WHERE name=?;", (program_name,))
+    )
+
+def get_failed_downloads():
+    # Returns {save_dir: [program names]}
+    failed = collections.defaultdict(list)
+    for name, save_dir in get_connection().execute("SELECT name, save_dir FROM failed_downloads ORDER BY name;"):
+        failed[save_dir].append(name)
+    return failed
+
+def get_database_stats():
+    conn = get_connection()
+    row = conn.execute(
+        "SELECT (SELECT count(*) FROM names), (SELECT count(*) FROM subdomains WHERE removed IS NULL), "
+        "(SELECT count(*) FROM subdomains WHERE removed IS NOT NULL), (SELECT count(*) FROM runs), "
+        "(SELECT max(started_at) FROM runs), (SELECT count(*) FROM failed_downloads), (SELECT count(*) FROM probes);"
+    ).fetchone()
+    stats = dict(zip(("programs", "subdomains", "removed", "runs", "last_run", "failed_downloads", "probed"), row))
+    stats["database_mb"] = round(os.path.getsize(DB_PATH) / 1048576, 1)
+    return stats
+
+def insert_new_subdomains(conn, program_id, run_id, subdomains):
+    # Runs on the writer thread; returns the subdomains that were actually inserted or came back after removal
+    rows = conn.execute(
+        "INSERT INTO subdomains(subdomain, rname, program_ID, first_seen) "
+        "SELECT value, reverse_labels(value), ?, ? FROM json_each(?) WHERE true "
+        "ON CONFLICT(subdomain) DO UPDATE SET program_ID=excluded.program_ID, removed=NULL WHERE removed IS NOT NULL "
+        "RETURNING subdomain;",
+        (program_id, run_id, json.dumps(subdomains))
+    ).fetchall()
+    inserted = [r[0] for r in rows]
+    conn.execute(
+        "INSERT OR REPLACE INTO subdomain_events(subdomain, run_ID, added) SELECT value, ?, 1 FROM json_each(?);",
+        (run_id, json.dumps(inserted))
+    )
+    if len(inserted) < len(subdomains):
+        # Stored by another program meanwhile
+        add_shared(conn, program_id, list(set(subdomains).difference(inserted)))
+    return inserted
+
+def add_shared(conn, program_id, subdomains):
+    # Runs on the writer thread
+    conn.execute(
+        "INSERT OR IGNORE INTO shared_subdomains(subdomain, program_ID) SELECT subdomain, ? FROM subdomains "
+        "WHERE subdomain IN (SELECT value FROM json_each(?)) AND program_ID != ? AND removed IS NULL;",
+        (program_id, json.dumps(subdomains), program_id)
+    )
+
+def drop_shared(conn, program_id, run_id, subdomains):
+    # Runs on the writer thread; returns the subdomains that were removed as well
+    conn.execute(
+        "DELETE FROM shared_subdomains WHERE program_ID=? AND subdomain IN (SELECT value FROM json_each(?));",
+        (program_id, json.dumps(subdomains))
+    )
+    # Names handed to this program by a concurrent mark_removed() after its own diff ran
+    owned = [r[0] for r in conn.execute(
+        "SELECT subdomain FROM subdomains WHERE subdomain IN (SELECT value FROM json_each(?)) AND program_ID=? AND removed IS NULL;",
+        (json.dumps(subdomains), program_id)
+    )]
+    return mark_removed(conn, program_id, run_id, owned) if owned else []
+
+def mark_removed(conn, program_id, run_id, subdomains):
+    # Runs on the writer thread; returns the subdomains that no other program lists either.
+    # The others move to the program with the highest ID among those that still list them.
+    names = json.dumps(subdomains)
+    conn.execute(
+        "UPDATE subdomains SET program_ID=(SELECT max(m.program_ID) FROM shared_subdomains m WHERE m.subdomain=subdomains.subdomain) "
+        "WHERE subdomain IN (SELECT value FROM json_each(?1)) AND program_ID=?2 AND removed IS NULL "
+        "AND EXISTS (SELECT 1 FROM shared_subdomains m WHERE m.subdomain=subdomains.subdomain);",
+        (names, program_id)
+    )
+    conn.execute(
+        "DELETE FROM shared_subdomains WHERE subdomain IN (SELECT value FROM json_each(?)) "
+        "AND program_ID=(SELECT d.program_ID FROM subdomains d WHERE d.subdomain=shared_subdomains.subdomain);",
+        (names,)
+    )
+    removed = [r[0] for r in conn.execute(
+        "UPDATE subdomains SET removed=? WHERE subdomain IN (SELECT value FROM json_each(?)) AND program_ID=? AND removed IS NULL "
+        "RETURNING subdomain;",
+        (run_id, names, program_id)
+    )]
+    conn.execute(
+        "INSERT OR REPLACE INTO subdomain_events(subdomain, run_ID, added) SELECT value, ?, 0 FROM json_each(?);",
+        (run_id, json.dumps(removed))
+    )
+    return removed
+
+##########################################
+# Run history
+##########################################
+def start_run(save_dir, program_count):
+    # Returns the run ID
+    return get_db_writer().submit(
+        lambda conn: conn.execute(
+            "INSERT INTO runs(save_dir, started_at, programs) VALUES(?, DATETIME('NOW'), ?);",
+            (save_dir, program_count)
+        ).lastrowid
+    ).result()
+
+def finish_run(run_id):
+    known = get_known_filter()
+    if known is not None:
+        known.sync(run_id)
+    return get_db_writer().submit(
+        lambda conn: conn.execute(
+            "UPDATE runs SET finished_at=DATETIME('NOW'), "
+            "added=(SELECT count(*) FROM subdomain_events WHERE run_ID=?1 AND added), "
+            "removed=(SELECT count(*) FROM subdomain_events WHERE run_ID=?1 AND NOT added) WHERE ID=?1;",
+            (run_id,)
+        )
+    )
+
+def record_program_run(program_name, run_id):
+    # The program's list was seen complete in this run (downloaded, not modified or unchanged)
+    return get_db_writer().submit(
+        lambda conn: conn.execute(
+            "INSERT OR IGNORE INTO program_runs(program_ID, run_ID) SELECT ID, ? FROM names WHERE name=?;",
+            (run_id, program_name)
+        )
+    )
+
+def get_output_version(program_name, save_dir):
+    row = get_connection().execute(
+        "SELECT last_updated FROM program_outputs WHERE name=? AND save_dir=?;", (program_name, save_dir)
+    ).fetchone()
+    return row[0] if row else None
+
+def record_output(program_name, save_dir, last_updated):
+    return get_db_writer().submit(
+        lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO program_outputs(name, save_dir, last_updated) VALUES(?, ?, ?);",
+            (program_name, save_dir, last_updated)
+        )
+    )
+
+def get_runs(limit=20):
+    # Most recent first: (ID, save_dir, started_at, finished_at, programs, added, removed)
+    return get_connection().execute(
+        "SELECT ID, save_dir, started_at, finished_at, programs, added, removed FROM runs ORDER BY ID DESC LIMIT ?;",
+        (limit,)
+    ).fetchall()
+
+def find_run(when):
+    # Latest run started at or before the given "YYYY-MM-DD[ HH:MM:SS]" (UTC)
+    if len(when) == 10:
+        when += " 23:59:59"
+    row = get_connection().execute("SELECT max(ID) FROM runs WHERE started_at <= ?;", (when,)).fetchone()
+    return row[0]
+
+def iter_run_diff(old_run, new_run):
+    # Yields (subdomain, program, added) for names whose state differs between the two runs.
+    # Only the events recorded after old_run are read; names stored before history started count as present.
+    rows = get_connection().execute(
+        "SELECT e.subdomain, n.name, e.added FROM subdomain_events e "
+        "JOIN subdomains s ON s.subdomain=e.subdomain LEFT JOIN names n ON n.ID=s.program_ID "
+        "WHERE e.run_ID > :old AND e.run_ID <= :new "
+        "AND e.run_ID=(SELECT max(l.run_ID) FROM subdomain_events l WHERE l.subdomain=e.subdomain AND l.run_ID <= :new) "
+        "AND e.added != coalesce((SELECT p.added FROM subdomain_events p WHERE p.subdomain=e.subdomain AND p.run_ID <= :old "
+        "ORDER BY p.run_ID DESC LIMIT 1), s.first_seen IS NULL);",
+        {"old": old_run, "new": new_run}
+    )
+    while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+        for subdomain, program, added in chunk:
+            yield subdomain, program, bool(added)
+
+def write_run_diff(old_run, new_run, path):
+    # "+name" for added and "-name" for removed subdomains; returns (added, removed)
+    counts = collections.Counter()
+    with open_text(path, "w") as f:
+        for subdomain, _, added in iter_run_diff(old_run, new_run):
+            f.write(("+" if added else "-") + subdomain + "\n")
+            counts[added] += 1
+    return counts[True], counts[False]
+
+##########################################
+# Suffix and ownership lookups
+##########################################
+def suffix_bounds(domain):
+    # rname range holding the domain itself and every name under it
+    prefix = reverse_labels(normalize_subdomain(domain) or domain.strip().lower().rstrip("."))
+    return prefix, prefix[:-1] + "/"
+
+def iter_suffix(domain, include_removed=False):
+    # Yields (subdomain, program, removed run ID) for the domain and every name under it, parents before children
+    low, high = suffix_bounds(domain)
+    rows = get_connection().execute(
+        "SELECT s.subdomain, n.name, s.removed FROM subdomains s LEFT JOIN names n ON n.ID=s.program_ID "
+        "WHERE s.rname >= ? AND s.rname < ? AND (? OR s.removed IS NULL) ORDER BY s.rname;",
+        (low, high, include_removed)
+    )
+    while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+        yield from chunk
+
+def get_apex_counts(program_name=None, limit=None):
+    # [(apex, current subdomains)], largest first, over all programs or one
+    conn = get_connection()
+    counts = collections.Counter()
+    if program_name is not None:
+        rows = conn.execute(
+            "SELECT s.subdomain FROM names n JOIN subdomains s ON s.program_ID=n.ID WHERE n.name=?1 AND s.removed IS NULL "
+            "UNION ALL SELECT m.subdomain FROM names n JOIN shared_subdomains m ON m.program_ID=n.ID WHERE n.name=?1;",
+            (program_name,)
+        )
+        while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+            counts.update(apex_domain(r[0]) for r in chunk)
+        return counts.most_common(limit)
+    # The names of an apex are adjacent in rname order: count each apex's range in the index and seek past it
+    row = conn.execute("SELECT subdomain FROM subdomains ORDER BY rname LIMIT 1;").fetchone()
+    while row:
+        apex = apex_domain(row[0])
+        low, high = suffix_bounds(apex)
+        if is_public_suffix(apex):
+            # A bare co.uk is no apex: its range would swallow every *.co.uk domain. Count the name
+            # alone and step one label down, to the first name under it.
+            counts[apex] = conn.execute(
+                "SELECT count(*) FROM subdomains WHERE rname = ? AND removed IS NULL;", (low,)
+            ).fetchone()[0]
+            row = conn.execute("SELECT subdomain FROM subdomains WHERE rname > ? ORDER BY rname LIMIT 1;", (low,)).fetchone()
+            continue
+        counts[apex] = conn.execute(
+            "SELECT count(*) FROM subdomains WHERE rname >= ? AND rname < ? AND removed IS NULL;", (low, high)
+        ).fetchone()[0]
+        row = conn.execute("SELECT subdomain FROM subdomains WHERE rname >= ? ORDER BY rname LIMIT 1;", (high,)).fetchone()
+    return [(apex, count) for apex, count in counts.most_common(limit) if count]
+
+def resolve_owner(host):
+    # Returns (domain, [(program, names)]) for the closest of host and its parents up to the apex
+    # that has current names under it, or (None, []) when nothing under the apex is known
+    name = normalize_subdomain(host) or host.strip().lower().rstrip(".")
+    apex = apex_domain(name)
+    conn = get_connection()
+    labels = name.split(".")
+    for start in range(len(labels)):
+        domain = ".".join(labels[start:])
+        low, high = suffix_bounds(domain)
+        # A bare public suffix owns only itself, not every registrant under it
+        where, params = ("s.rname = ?", (low,)) if is_public_suffix(domain) else ("s.rname >= ? AND s.rname < ?", (low, high))
+        owners = conn.execute(
+            "SELECT n.name, count(*) AS c FROM subdomains s LEFT JOIN names n ON n.ID=s.program_ID "
+            "WHERE " + where + " AND s.removed IS NULL GROUP BY s.program_ID ORDER BY c DESC;",
+            params
+        ).fetchall()
+        if owners or domain == apex:
+            return (domain, owners) if owners else (None, [])
+    return None, []
 
 ##########################################
 # File and download functions
 ##########################################
+INGEST_CHUNK_SIZE = 50000             # subdomains per DB/output batch
+TRACK_REMOVED     = os.environ.get("CHAOS_TRACK_REMOVED", "0") == "1"  # also write removed_<dir>.txt
+
 def get_file_name(download_link):
     return os.path.basename(download_link)
 
-def unzip_files(file_path, save_dir):
-    try:
-        with zipfile.ZipFile(file_path, 'r') as zf:
-            zf.extractall(save_dir)
-        os.remove(file_path)
-    except Exception as e:
-        print(f"Error unzipping {file_path}: {e}")
+def iter_zip_subdomains(zip_file):
+    # Stream the lines of every .txt member without extracting to disk
+    with zipfile.ZipFile(zip_file, 'r') as zf:
+        for member in zf.infolist():
+            if member.is_dir() or not member.filename.endswith(".txt"):
+                continue
+            with zf.open(member) as raw:
+                for line in io.TextIOWrapper(raw, encoding="utf-8", errors="replace"):
+                    line = line.strip()
+                    if line:
+                        yield line
 
-def download(download_link, save_dir, file_name, program_name, platform, offer_bounty):
-    # Ensure the program folder exists
-    program_dir = Path(save_dir) / program_name
-    program_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Insert the program into the database (if not already present)
-    insert_table_name(program_name, platform, offer_bounty)
-    
+def iter_chunks(iterable, size=INGEST_CHUNK_SIZE):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+class IncompleteDownload(Exception):
+    pass
+
+def fetch_to_part(url, part_path, cache_entry=None):
+    # One attempt; appends to part_path when the server honours the Range request
+    meta_path = part_path.with_name(part_path.name + ".json")
+    offset = part_path.stat().st_size if part_path.exists() else 0
+    meta = json.loads(meta_path.read_text()) if offset and meta_path.exists() else {}
+    validator = meta.get("etag") or meta.get("last_modified")
+    if offset and validator:
+        headers = request_headers()
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+    else:
+        offset = 0
+        headers = request_headers(cache_entry)
+
+    with http_pool.open(url, headers) as response:
+        if response.status == 304:
+            return NOT_MODIFIED
+        expected = None
+        content_range = response.getheader("Content-Range", "")
+        if response.status == 206 and content_range.startswith(f"bytes {offset}-"):
+            mode = "ab"
+            expected = int(content_range.rsplit("/", 1)[1]) if not content_range.endswith("/*") else None
+        else:
+            # Full body: the server ignored the range or the file changed since the partial download
+            mode, offset = "wb", 0
+            meta = {"etag": response.getheader("ETag"), "last_modified": response.getheader("Last-Modified")}
+            meta_path.write_text(json.dumps(meta))
+        if expected is None and response.length is not None:
+            expected = offset + response.length
+        with part_path.open(mode) as f:
+            copy_response(response, f)
+
+    size = part_path.stat().st_size
+    if expected is not None and size != expected:
+        raise IncompleteDownload(f"received {size} of {expected} bytes")
+    meta_path.unlink(missing_ok=True)
+    return meta["etag"], meta["last_modified"]
+
+def download(download_link, file_name, cache_entry=None):
+    # Returns NOT_MODIFIED or (zip path, (etag, last_modified)); raises once the retries are used up
     # Encode URL to avoid Unicode issues
     parsed = urllib.parse.urlsplit(download_link)
     encoded_path = urllib.parse.quote(parsed.path)
     download_link = urllib.parse.urlunsplit((parsed.scheme, parsed.netloc, encoded_path, parsed.query, parsed.fragment))
-    
-    file_path = program_dir / file_name
+    import_network_modules()
+
+    DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    part_path = DOWNLOAD_DIR / f"{file_name}.part"
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            result = fetch_to_part(download_link, part_path, cache_entry)
+            break
+        except (OSError, http.client.HTTPException, IncompleteDownload) as e:
+            retryable = not isinstance(e, urllib.error.HTTPError) or e.code in (408, 416, 429) or e.code >= 500
+            if isinstance(e, urllib.error.HTTPError) and e.code == 416:
+                # Our partial file does not match the remote one any more; start over
+                part_path.unlink(missing_ok=True)
+            if not retryable or attempt == DOWNLOAD_RETRIES:
+                raise
+            # Exponential backoff with full jitter
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            print(f"{Yellow}[!]{White} {file_name} {e}, retrying in {delay:.1f}s ({attempt + 1}/{DOWNLOAD_RETRIES})")
+            time.sleep(delay)
+
+    if result is NOT_MODIFIED:
+        print(f"{Yellow}[=]{White} {file_name} Not modified {Green}[\u2713]{White}")
+        return NOT_MODIFIED
+    zip_path = part_path.with_name(file_name)
+    part_path.replace(zip_path)
+    print(f"{Red}[+]{White} {file_name} Done {Green}[\u2713]{White}")
+    return zip_path, result
+
+def write_lines(path, lines):
+    if not lines:
+        return
+    with output_lock:
+        with Path(path).open("a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+class NewSubdomains:
+    """Inserts one program's new names through the writer as they are found.
+
+    A couple of batches stay in flight so reading and writing overlap. The
+    writer only returns what it actually inserted; whatever it skipped was
+    stored already (by another program, or missed by the known-subdomain
+    filter) and is kept in `known` so it can still be staged.
+    """
+
+    def __init__(self, save_dir, program_id, run_id, prober=None):
+        self.save_dir = save_dir
+        self.program_id = program_id
+        self.run_id = run_id
+        self.prober = prober
+        self.pending = collections.deque()
+        self.count = 0
+        self.known = []
+
+    def submit(self, names):
+        self.pending.append((names, get_db_writer().submit(insert_new_subdomains, self.program_id, self.run_id, names)))
+        if len(self.pending) > 2:
+            self.collect()
+
+    def collect(self):
+        names, future = self.pending.popleft()
+        inserted = future.result()
+        write_lines(f"new_{self.save_dir}.txt", inserted)
+        if self.prober and inserted:
+            self.prober.submit(inserted)
+        if len(inserted) < len(names):
+            self.known.extend(set(names).difference(inserted))
+        self.count += len(inserted)
+
+    def finish(self):
+        # Returns the number of inserted names
+        while self.pending:
+            self.collect()
+        return self.count
+
+def diff_staged(program_id, run_id, save_dir, new):
+    # Set-based diff of the staged list against subdomains; returns the number of new rows
+    conn = get_connection()
+    writer = get_db_writer()
+    # Names nobody lists yet, and names another program owns that this one does not share yet
+    rows = conn.execute(
+        "SELECT s.subdomain, d.subdomain IS NULL FROM temp.staging s "
+        "LEFT JOIN main.subdomains d ON d.subdomain=s.subdomain AND d.removed IS NULL "
+        "WHERE d.subdomain IS NULL OR (d.program_ID != ?1 AND NOT EXISTS "
+        "(SELECT 1 FROM main.shared_subdomains m WHERE m.subdomain=s.subdomain AND m.program_ID=?1));",
+        (program_id,)
+    )
+    shared = []
+    while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+        fresh = [r[0] for r in chunk if r[1]]
+        if fresh:
+            new.submit(fresh)
+        if len(fresh) < len(chunk):
+            shared.append(writer.submit(add_shared, program_id, [r[0] for r in chunk if not r[1]]))
+    new_count = new.finish()
+    if new.known:
+        conn.execute("BEGIN;")
+        conn.executemany("INSERT OR IGNORE INTO temp.staging(subdomain) VALUES(?)", ((sd,) for sd in new.known))
+        conn.execute("COMMIT;")
+    # Names of this program that are no longer in its list. Names first seen in this run are
+    # in the list even when they skipped staging as certainly new.
+    rows = conn.execute(
+        "SELECT subdomain FROM main.subdomains d WHERE program_ID=? AND removed IS NULL AND first_seen IS NOT ? "
+        "AND NOT EXISTS (SELECT 1 FROM temp.staging s WHERE s.subdomain=d.subdomain);",
+        (program_id, run_id)
+    )
+    removals = []
+    while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+        removals.append(writer.submit(mark_removed, program_id, run_id, [r[0] for r in chunk]))
+    # Shared names this program no longer lists
+    rows = conn.execute(
+        "SELECT subdomain FROM main.shared_subdomains m WHERE program_ID=? "
+        "AND NOT EXISTS (SELECT 1 FROM temp.staging s WHERE s.subdomain=m.subdomain);",
+        (program_id,)
+    )
+    while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+        removals.append(writer.submit(drop_shared, program_id, run_id, [r[0] for r in chunk]))
+    for future in shared:
+        future.result()
+    for future in removals:
+        removed = future.result()
+        if TRACK_REMOVED:
+            write_lines(f"removed_{save_dir}.txt", removed)
+    return new_count
+
+def ingest_zip(zip_file, save_dir, program_id, run_id, prober=None):
+    # Returns the number of new subdomains
+    conn = get_connection()
+    new = NewSubdomains(save_dir, program_id, run_id, prober)
     try:
-        opener.retrieve(download_link, str(file_path))
-        unzip_files(str(file_path), str(program_dir))
-        print(f"{Red}[+]{White} {file_name} Done {Green}[\u2713]{White}")
-    except Exception as e:
-        print(f"Error downloading {file_name}: {e}")
+        conn.execute("DELETE FROM temp.staging;")
+        def stage(future):
+            with metrics.timer("normalize") as stats:
+                maybe, fresh, rejected = future.result()
+                stats["items"] = len(maybe) + len(fresh)
+            metrics.count("subdomains_rejected", rejected)
+            metrics.count("filter_new", len(fresh))
+            known = get_known_filter()
+            if known is not None:
+                known.count_added(len(fresh))
+            with metrics.timer("staging") as stats:
+                # Clean lines are collected here and merged into the sorted master file after the run
+                if MASTER_FILES:
+                    write_lines(f"{save_dir}.txt.incoming", maybe + fresh)
+                conn.execute("BEGIN;")
+                conn.executemany("INSERT OR IGNORE INTO temp.staging(subdomain) VALUES(?)", ((sd,) for sd in maybe))
+                conn.execute("COMMIT;")
+                stats["items"] = len(maybe)
+            # Names the filter has never seen skip staging and the lookup in subdomains
+            if fresh:
+                new.submit(fresh)
 
-def merge_sub_files_and_insert(save_dir, program_name):
-    program_dir = Path(save_dir) / program_name
-    txt_files = list(program_dir.glob("*.txt"))
-    all_subdomains = []
-
-    # Merge all text files into one master file
-    master_file = Path(f"{save_dir}.txt")
-    with master_file.open("a", encoding="utf-8") as outfile:
-        for file in txt_files:
-            with file.open("r", encoding="utf-8") as infile:
-                lines = infile.readlines()
-                outfile.write("".join(lines))
-                all_subdomains.extend([line.strip() for line in lines if line.strip()])
-    
-    # Batch insert into the database
-    with sqlite_lock:
-        cursor.execute("SELECT ID FROM names WHERE name=?", (program_name,))
-        row = cursor.fetchone()
-        if row:
-            program_id = row[0]
-            data_to_insert = [(sd, program_id) for sd in all_subdomains]
-            cursor.executemany(
-                "INSERT OR IGNORE INTO subdomains(subdomain, program_ID) VALUES(?, ?)",
-                data_to_insert
-            )
-            sqliteConnection.commit()
-    
-    # Also write new subdomains to a separate file
-    new_file_path = Path(f"new_{save_dir}.txt")
-    with new_file_path.open("a", encoding="utf-8") as new_file:
-        for sd in all_subdomains:
-            new_file.write(sd + "\n")
-
-def process_program(program, save_dir):
+        # Chunks are normalized in the process pool while the next ones are read from the zip
+        chunks = iter_chunks(iter_zip_subdomains(zip_file))
+        pending = collections.deque()
+        while True:
+            with metrics.timer("unzip") as stats:
+                chunk = next(chunks, None)
+                stats["items"] = len(chunk) if chunk else 0
+            if chunk is None:
+                break
+            pending.append(prepare_async(chunk))
+            if len(pending) > 2:
+                stage(pending.popleft())
+        while pending:
+            stage(pending.popleft())
+        with metrics.timer("diff") as stats:
+            stats["items"] = diff_staged(program_id, run_id, save_dir, new)
+        return stats["items"]
+    finally:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK;")
+        conn.execute("DELETE FROM temp.staging;")
+
+def output_stored_names(program_name, save_dir, last_updated):
+    # For a program that was not downloaded: add its list from chaos.db to <dir>.txt unless that version is in there
+    if not MASTER_FILES or get_output_version(program_name, save_dir) == last_updated:
+        return
+    rows = get_connection().execute(
+        "SELECT s.subdomain FROM names n JOIN subdomains s ON s.program_ID=n.ID WHERE n.name=?1 AND s.removed IS NULL "
+        "UNION ALL SELECT m.subdomain FROM names n JOIN shared_subdomains m ON m.program_ID=n.ID WHERE n.name=?1;",
+        (program_name,)
+    )
+    while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+        write_lines(f"{save_dir}.txt.incoming", [r[0] for r in chunk])
+    record_output(program_name, save_dir, last_updated)
+
+def process_program(program, save_dir, run_id, prober=None, force=False):
+    # Returns the number of bytes downloaded; force ignores the HTTP cache and fetches the zip again
     file_name    = get_file_name(program["URL"])
     program_name = program["name"]
     platform     = program["platform"]
     bounty       = program["bounty"]
-    download(program["URL"], save_dir, file_name, program_name, platform, bounty)
-    merge_sub_files_and_insert(save_dir, program_name)
+
+    # Skip programs whose zip has not changed since the last successful run
+    entry = None if force else get_cache_entry(program["URL"])
+    if entry and entry[2] == program["last_updated"]:
+        print(f"{Yellow}[=]{White} {file_name} Unchanged since last run {Green}[\u2713]{White}")
+        metrics.count("programs_unchanged")
+        output_stored_names(program_name, save_dir, program["last_updated"])
+        record_program_run(program_name, run_id)
+        return 0
+    # Insert the program into the database (if not already present)
+    program_id = insert_table_name(program_name, platform, bounty)
+    started = time.perf_counter()
+    size = 0
+    try:
+        result = download(program["URL"], file_name, entry)
+        download_seconds = time.perf_counter() - started
+        if result is NOT_MODIFIED:
+            metrics.record("download", download_seconds, 1)
+            metrics.count("programs_not_modified")
+            output_stored_names(program_name, save_dir, program["last_updated"])
+            update_cache_entry(program["URL"], entry[0], entry[1], program["last_updated"]).result()
+        else:
+            zip_path, validators = result
+            size = zip_path.stat().st_size
+            metrics.record("download", download_seconds, 1, size)
+            try:
+                with metrics.timer("ingest") as stats:
+                    new_count = stats["items"] = ingest_zip(zip_path, save_dir, program_id, run_id, prober)
+                if STORE_DIR:
+                    with metrics.timer("store") as stats:
+                        stats["bytes"] = size
+                        store_zip(program_name, zip_path)
+            finally:
+                zip_path.unlink(missing_ok=True)
+            print(f"{Red}[+]{White} {program_name}: {new_count} new subdomains")
+            if MASTER_FILES:
+                record_output(program_name, save_dir, program["last_updated"])
+            update_cache_entry(program["URL"], validators[0], validators[1], program["last_updated"]).result()
+            metrics.count("programs_downloaded")
+            metrics.program(
+                program_name, bytes=size, download_seconds=round(download_seconds, 3),
+                mb_per_sec=round(size / download_seconds / 1048576, 2) if download_seconds else None,
+                total_seconds=round(time.perf_counter() - started, 3), new_subdomains=new_count,
+            )
+    except Exception as e:
+        # Recorded so "retry failed downloads" can pick up only these programs
+        print(f"Error downloading {file_name}: {e}")
+        metrics.count("programs_failed")
+        record_failed_download(program_name, save_dir, e)
+        return size
+    clear_failed_download(program_name)
+    record_program_run(program_name, run_id)
+    return size
 
 ##########################################
-# Generic download for filtered programs
+# Content-addressed program store
 ##########################################
-def download_filtered_programs(filter_func, save_dir):
-    programs = [p for p in data_json if filter_func(p)]
-    print(f"Starting download of {len(programs)} programs...")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        futures = {executor.submit(process_program, prog, save_dir): prog for prog in programs}
-        for future in concurrent.futures.as_completed(futures):
-            prog = futures[future]
-            try:
-                future.result()
-            except Exception as exc:
-                print(f"{prog['name']} generated an exception: {exc}")
-    ask(save_dir)
+# objects/<hash[:2]>/<hash>.zip holds every distinct upstream zip once (they are compressed already),
+# refs/<program> the hash of the program's latest zip and views/<dir> one "<hash>  <program>" line
+# per program of the last download into <dir>, so filtered views cost a manifest instead of a copy.
+def object_path(digest):
+    return Path(STORE_DIR, "objects", digest[:2], f"{digest}.zip")
+
+def ref_path(program_name):
+    return Path(STORE_DIR, "refs", urllib.parse.quote(program_name, safe=""))
+
+def view_path(save_dir):
+    return Path(STORE_DIR, "views", save_dir)
+
+def replace_text(path, text):
+    # Readers see the old or the new file, never a partial one
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_path.write_text(text, encoding="utf-8")
+    os.replace(tmp_path, path)
+
+def store_zip(program_name, zip_path):
+    # Moves a downloaded zip into the store, or drops it when the same content is stored already; returns its hash
+    digest = hashlib.sha256()
+    with open(zip_path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    digest = digest.hexdigest()
+    target = object_path(digest)
+    if target.exists():
+        zip_path.unlink()
+    else:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # A plain rename unless the download directory is on another file system
+        tmp_path = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.move(zip_path, tmp_path)
+        try:
+            os.replace(tmp_path, target)
+        except FileNotFoundError:
+            # Another thread stored the same content meanwhile
+            if not target.exists():
+                raise
+            tmp_path.unlink(missing_ok=True)
+    replace_text(ref_path(program_name), digest + "\n")
+    return digest
+
+def get_ref(program_name):
+    # Hash of the program's latest stored zip, or None
+    try:
+        return ref_path(program_name).read_text(encoding="utf-8").strip() or None
+    except FileNotFoundError:
+        return None
+
+def write_view(save_dir, program_names, update=False):
+    # Returns the number of programs listed; programs never stored (e.g. unchanged since before the store) are left out.
+    # update keeps the other programs of an existing view, for retries that only fetch some of them.
+    entries = [(digest, name) for name in program_names for digest in [get_ref(name)] if digest]
+    if update and view_path(save_dir).exists():
+        names = set(program_names)
+        entries = [(digest, name) for digest, name in read_view(save_dir) if name not in names] + entries
+    replace_text(view_path(save_dir), "".join(f"{digest}  {name}\n" for digest, name in entries))
+    return len(entries)
+
+def read_view(save_dir):
+    # [(hash, program)] of the view, in the order the programs were listed
+    with view_path(save_dir).open(encoding="utf-8") as f:
+        return [tuple(line.rstrip("\n").split("  ", 1)) for line in f if line.strip()]
+
+def iter_stored_subdomains(digest):
+    # Streams the normalized names of one stored zip, deduplicated per chunk like the ingest path
+    for chunk in iter_chunks(iter_zip_subdomains(object_path(digest))):
+        yield from normalize_chunk(chunk)[0]
+
+def iter_store(save_dir=None, program_names=None):
+    # Yields (program, subdomain) for the programs of a view, or for the latest zips of the given programs
+    if save_dir is not None:
+        entries = read_view(save_dir)
+    else:
+        entries = [(digest, name) for name in program_names for digest in [get_ref(name)] if digest]
+    for digest, program in entries:
+        for subdomain in iter_stored_subdomains(digest):
+            yield program, subdomain
+
+def prune_store():
+    # Deletes the objects no ref or view points to; returns (objects removed, bytes freed)
+    objects = Path(STORE_DIR, "objects")
+    if not STORE_DIR or not objects.exists():
+        return 0, 0
+    live = {path.read_text(encoding="utf-8").strip() for path in Path(STORE_DIR, "refs").glob("*") if path.is_file()}
+    for path in Path(STORE_DIR, "views").glob("*"):
+        if path.is_file() and not path.name.endswith(".tmp"):
+            live.update(line.split("  ", 1)[0] for line in path.read_text(encoding="utf-8").splitlines() if line)
+    removed = freed = 0
+    for path in objects.glob("*/*.zip"):
+        if path.stem not in live:
+            freed += path.stat().st_size
+            path.unlink()
+            removed += 1
+    return removed, freed
 
 ##########################################
-# Filter lambdas for various selections
+# Known-subdomain filter (memory-mapped Bloom filter)
 ##########################################
-def filter_all(p): 
-    return True
+class KnownFilter:
+    """Bloom filter of every subdomain in chaos.db, kept in a mapped file.
+
+    split() sorts names into "maybe stored" and "certainly new"; only the
+    first group needs a lookup in subdomains. New names are added as they
+    are classified, before they reach the database: an extra bit only
+    costs a lookup, and a missing bit (stale or half-built file, or two
+    processes updating the same byte) only sends a known name down the
+    new-name path, where the writer's upsert catches it. So the filter
+    affects speed but never results. The header records the last run the filter saw; a mismatch
+    with chaos.db makes open_known_filter() rebuild it.
+    """
+
+    HEADER = struct.Struct("<8sQIQq")   # magic, bits, hashes, names added, last run ID (-1 = incomplete)
+    MAGIC = b"CHAOSBF1"
+    HASHES = 4
+    BITS_PER_NAME = 12                  # ~0.7% false positives at capacity
+    MIN_CAPACITY = 1 << 20
+    SAMPLE = 1024                       # names checked before giving up on a list that is almost all known
 
-def filter_offer_bounty(p): 
-    return p["bounty"] == True
+    def __init__(self, path):
+        # Maps an existing filter file; raises ValueError if it is not one
+        self.lock = threading.Lock()
+        with open(path, "r+b") as f:
+            self.map = mmap.mmap(f.fileno(), 0)
+        magic, self.bits, self.hashes, self.added, self.last_run = self.HEADER.unpack_from(self.map)
+        if magic != self.MAGIC or len(self.map) != self.HEADER.size + (self.bits + 7) // 8:
+            self.map.close()
+            raise ValueError(f"{path} is not a known-subdomain filter")
+        self.capacity = self.bits // self.BITS_PER_NAME
 
-def filter_not_offer_bounty(p): 
-    return p["bounty"] == False
+    @classmethod
+    def create(cls, path, capacity):
+        bits = max(cls.MIN_CAPACITY, capacity) * cls.BITS_PER_NAME
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, bits, cls.HASHES, 0, -1))
+            f.truncate(cls.HEADER.size + (bits + 7) // 8)
+        os.replace(tmp_path, path)
+        return cls(path)
 
-def filter_by_platform(p, platform): 
-    # For "self hosted", platform is empty string
-    return p["platform"].lower() == platform.lower() if platform else p["platform"] == ""
+    def split(self, names, add=False):
+        # Returns (maybe stored, certainly new); with add=True the new names are added right away.
+        # Bits are h1 + i * h2 (double hashing), inlined for speed.
+        maybe, new = [], []
+        bitmap, base, bits, probes, crc = self.map, self.HEADER.size * 8, self.bits, range(self.hashes), zlib.crc32
+        for index, name in enumerate(names):
+            if index == self.SAMPLE and len(new) * 100 < index:
+                # A list that is almost all known needs the lookups anyway; checking the rest costs more than it saves
+                maybe.extend(names[index:])
+                break
+            data = name.encode()
+            h1, h2 = crc(data), crc(data, 0x5BD1E995) | 1
+            for i in probes:
+                bit = base + (h1 + i * h2) % bits
+                if not bitmap[bit >> 3] & (1 << (bit & 7)):
+                    new.append(name)
+                    if add:
+                        for j in probes:
+                            bit = base + (h1 + j * h2) % bits
+                            bitmap[bit >> 3] |= 1 << (bit & 7)
+                    break
+            else:
+                maybe.append(name)
+        return maybe, new
 
-def filter_new_subdomain(p): 
-    return p["change"] != 0
+    def add_many(self, names):
+        bitmap, base, bits, probes, crc = self.map, self.HEADER.size * 8, self.bits, range(self.hashes), zlib.crc32
+        with self.lock:
+            for name in names:
+                data = name.encode()
+                h1, h2 = crc(data), crc(data, 0x5BD1E995) | 1
+                for i in probes:
+                    bit = base + (h1 + i * h2) % bits
+                    bitmap[bit >> 3] |= 1 << (bit & 7)
+            self.added += len(names)
 
-def filter_new_and_offer(p): 
-    return p["change"] != 0 and p["bounty"] == True
+    def count_added(self, count):
+        # For names added by split() in a worker process, which shares the mapping but not this object
+        with self.lock:
+            self.added += count
 
-def filter_new_and_not_offer(p): 
-    return p["change"] != 0 and p["bounty"] == False
+    @property
+    def full(self):
+        return self.added > self.capacity
+
+    def sync(self, run_id):
+        # Marks the filter as complete up to run_id
+        with self.lock:
+            self.last_run = run_id
+            self.HEADER.pack_into(self.map, 0, self.MAGIC, self.bits, self.hashes, self.added, self.last_run)
+            self.map.flush()
+
+    def close(self):
+        with self.lock:
+            self.HEADER.pack_into(self.map, 0, self.MAGIC, self.bits, self.hashes, self.added, self.last_run)
+            self.map.close()
+
+def open_known_filter(path=BLOOM_PATH):
+    # Loads the filter, or rebuilds it from chaos.db when it is missing, stale or over capacity
+    if not path:
+        return None
+    conn = get_connection()
+    last_run = conn.execute("SELECT coalesce(max(ID), 0) FROM runs;").fetchone()[0]
+    try:
+        known = KnownFilter(path)
+        if known.last_run == last_run and not known.full:
+            return known
+        known.close()
+    except (OSError, ValueError, struct.error):
+        pass
+    count = conn.execute("SELECT count(*) FROM subdomains;").fetchone()[0]
+    if count:
+        print(f"{Yellow}[*]{White} Building the known-subdomain filter from {count} subdomains...")
+    known = KnownFilter.create(path, 2 * count)
+    rows = conn.execute("SELECT subdomain FROM subdomains;")
+    while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+        known.add_many([r[0] for r in chunk])
+    known.sync(last_run)
+    return known
+
+known_filter = None
+known_filter_loaded = False
+known_filter_lock = threading.Lock()
+
+def get_known_filter():
+    # None when CHAOS_BLOOM is off
+    global known_filter, known_filter_loaded
+    with known_filter_lock:
+        if not known_filter_loaded:
+            known_filter = open_known_filter()
+            if known_filter is not None:
+                atexit.register(known_filter.close)
+            known_filter_loaded = True
+    return known_filter
 
 ##########################################
-# Download functions for menu options
+# Sorted, deduplicated master files (external merge sort)
 ##########################################
-def download_all_programmes():
-    base_dir = "all_programmes"
-    download_filtered_programs(filter_all, base_dir)
+class UnsortedInput(Exception):
+    pass
 
-def download_offer_bounty():
-    base_dir = "offer_bounty"
-    download_filtered_programs(filter_offer_bounty, base_dir)
+def open_text(path, mode="r"):
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
 
-def download_not_offer_bounty():
-    base_dir = "not_offer_bounty"
-    download_filtered_programs(filter_not_offer_bounty, base_dir)
+def iter_lines(path, check_sorted=False):
+    previous = ""
+    with open_text(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if check_sorted:
+                if line < previous:
+                    raise UnsortedInput(path)
+                previous = line
+            yield line
 
-def download_by_platform(platform_name):
-    base_dir = platform_name if platform_name else "self_hosted"
-    download_filtered_programs(lambda p: filter_by_platform(p, platform_name), base_dir)
+def write_sorted(lines, path):
+    with open_text(path, "w") as f:
+        for line in lines:
+            f.write(line + "\n")
 
-def download_new_subdomain():
-    base_dir = "new_subdomains"
-    download_filtered_programs(filter_new_subdomain, base_dir)
+def merge_unique(iterables):
+    previous = None
+    for line in heapq.merge(*iterables):
+        if line != previous:
+            yield line
+            previous = line
 
-def new_subdomains_and_offer_bounty():
-    base_dir = "new_subdomains_and_offer_bounty"
-    download_filtered_programs(lambda p: filter_new_and_offer(p), base_dir)
+def spill_runs(paths, run_dir, memory_limit):
+    # Split unsorted inputs into sorted, deduplicated run files of at most memory_limit bytes each
+    runs, buffer, size = [], set(), 0
+    def flush():
+        run = Path(run_dir) / f"run{len(runs)}.txt"
+        write_sorted(sorted(buffer), run)
+        runs.append(run)
+        buffer.clear()
+    for path in paths:
+        for line in iter_lines(path):
+            if line not in buffer:
+                buffer.add(line)
+                size += len(line) + 100  # rough per-string and set-slot overhead
+            if size >= memory_limit:
+                flush()
+                size = 0
+    if buffer:
+        flush()
+    return runs
 
-def new_subdomain_and_offer_bounty_and_platform(platform_name):
-    base_dir = f"new_subdomain_and_offer_bounty_and_{platform_name}" if platform_name else "new_subdomain_and_offer_bounty_and_self_hosted"
-    download_filtered_programs(lambda p: filter_new_and_offer(p) and filter_by_platform(p, platform_name), base_dir)
+def external_sort(unsorted_paths, sorted_paths, output_path, memory_limit=SORT_MEMORY_LIMIT):
+    # Writes the sorted union of all inputs to output_path; inputs may include output_path itself
+    output_path = Path(output_path)
+    with tempfile.TemporaryDirectory(dir=output_path.parent, prefix=".sort-") as run_dir:
+        runs = spill_runs(unsorted_paths, run_dir, memory_limit)
+        # Keep the number of files open during a merge bounded. Each step must fold at least two
+        # runs into one, however many sorted inputs the final merge has to open as well.
+        fan_in = max(MERGE_FAN_IN, len(sorted_paths) + 2)
+        group_size = fan_in - len(sorted_paths)
+        while len(runs) + len(sorted_paths) > fan_in:
+            group, runs = runs[:group_size], runs[group_size:]
+            merged = Path(run_dir) / f"merge{len(runs)}-{time.monotonic_ns()}.txt"
+            write_sorted(merge_unique([iter_lines(r) for r in group]), merged)
+            runs.append(merged)
+        tmp_path = Path(run_dir) / ("output" + "".join(output_path.suffixes[-1:]))
+        write_sorted(
+            merge_unique([iter_lines(r) for r in runs] + [iter_lines(p, check_sorted=True) for p in sorted_paths]),
+            tmp_path
+        )
+        os.replace(tmp_path, output_path)
 
-def new_subdomain_and_platform(platform_name):
-    base_dir = f"new_subdomain_and_platform_{platform_name}" if platform_name else "new_subdomain_and_platform_self_hosted"
-    download_filtered_programs(lambda p: filter_new_subdomain(p) and filter_by_platform(p, platform_name), base_dir)
+def master_file(save_dir):
+    return Path(f"{save_dir}.txt.gz" if MASTER_GZIP else f"{save_dir}.txt")
 
-def new_subdomain_and_not_offer_bounty():
-    base_dir = "new_subdomain_and_not_offer_bounty"
-    download_filtered_programs(lambda p: filter_new_and_not_offer(p), base_dir)
+def build_master_files(save_dir):
+    # Merge this run's raw lines into the sorted master and sort the new_ file in place
+    new_file = Path(f"new_{save_dir}.txt")
+    if new_file.exists():
+        external_sort([new_file], [], new_file)
+    if not MASTER_FILES:
+        return
+    incoming = Path(f"{save_dir}.txt.incoming")
+    master = master_file(save_dir)
+    other = Path(f"{save_dir}.txt") if MASTER_GZIP else Path(f"{save_dir}.txt.gz")
+    existing = [p for p in (master, other) if p.exists()]
+    if incoming.exists() or other.exists():
+        try:
+            external_sort([incoming] if incoming.exists() else [], existing, master)
+        except UnsortedInput:
+            # Master written by an older version (appended, unsorted): sort it once
+            external_sort([p for p in (incoming, *existing) if p.exists()], [], master)
+        incoming.unlink(missing_ok=True)
+        if other.exists():
+            other.unlink()
 
-def new_subdomain_and_not_offer_bounty_and_platform(platform_name):
-    base_dir = f"new_subdomain_and_not_offer_bounty_and_{platform_name}" if platform_name else "new_subdomain_and_not_offer_bounty_and_self_hosted"
-    download_filtered_programs(lambda p: filter_new_and_not_offer(p) and filter_by_platform(p, platform_name), base_dir)
+##########################################
+# Generic download for filtered programs
+##########################################
+SCHEDULES = {
+    # Longest jobs first keeps one big zip from being the last thing running
+    "largest": lambda p: -(p.get("count") or 0),
+    # Programs with new subdomains first, smallest first among them, so new names show up early
+    "changed": lambda p: (-(p.get("change") or 0), p.get("count") or 0),
+}
 
-def offer_bounty_and_platform(platform_name):
-    base_dir = f"offer_bounty_and_{platform_name}" if platform_name else "offer_bounty_and_self_hosted"
-    download_filtered_programs(lambda p: p["bounty"] == True and filter_by_platform(p, platform_name), base_dir)
+def schedule_programs(programs, order=SCHEDULE):
+    if order not in SCHEDULES:
+        return list(programs)
+    return sorted(programs, key=SCHEDULES[order])
 
-def not_offer_bounty_and_platform(platform_name):
-    base_dir = f"not_offer_bounty_and_{platform_name}" if platform_name else "not_offer_bounty_and_self_hosted"
-    download_filtered_programs(lambda p: p["bounty"] == False and filter_by_platform(p, platform_name), base_dir)
+def shard_of(program_name, count=SHARD_COUNT):
+    # Stable across machines and Python versions, unlike hash()
+    return zlib.crc32(program_name.encode()) % count + 1
+
+def shard_programs(programs, save_dir):
+    # In shard mode: this shard's programs and its own output directory name
+    if not SHARD:
+        return programs, save_dir
+    selected = [p for p in programs if shard_of(p["name"]) == SHARD_INDEX]
+    print(f"Shard {SHARD_INDEX}/{SHARD_COUNT}: {len(selected)} of {len(programs)} programs")
+    if not save_dir.endswith(SHARD_SUFFIX):
+        save_dir += SHARD_SUFFIX
+    return selected, save_dir
+
+def download_programs(programs, save_dir, probe_tool=STREAM_PROBE, interactive=True,
+                      order=SCHEDULE, deadline=RUN_DEADLINE, byte_budget=BYTE_BUDGET, force=False, resume=False):
+    # resume continues the last run into save_dir (retries, deferred programs) instead of starting over
+    programs, save_dir = shard_programs(programs, save_dir)
+    print(f"Starting download of {len(programs)} programs...")
+    # new_/removed_ files hold the diff of the last run, including what its retries add
+    for path in (f"new_{save_dir}.txt", f"removed_{save_dir}.txt"):
+        if os.path.exists(path) and not resume:
+            os.remove(path)
+    # Opened before start_run() adds this run, or it no longer matches chaos.db and gets rebuilt
+    get_known_filter()
+    get_normalize_pool()
+    # Optionally probe new subdomains as each program finishes instead of after the run
+    prober = None
+    if probe_tool:
+        try:
+            prober = make_prober(probe_tool, save_dir)
+        except (OSError, KeyError) as e:
+            print(f"{Yellow}[!]{White} Cannot start {probe_tool} ({e}), probing after the downloads instead")
+    run_id = start_run(save_dir, len(programs))
+    waiting = collections.deque(schedule_programs(programs, order))
+    started, downloaded = time.monotonic(), 0
+    def limit_reached():
+        if deadline and time.monotonic() - started >= deadline:
+            return "deadline reached"
+        if byte_budget and downloaded >= byte_budget:
+            return "byte budget used"
+        return None
+
+    # Programs are handed to the pool one at a time so the deadline and budget apply to every start
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        running = {}
+        while waiting or running:
+            while waiting and len(running) < DOWNLOAD_WORKERS and not limit_reached():
+                prog = waiting.popleft()
+                running[executor.submit(run_profiled, process_program, prog, save_dir, run_id, prober, force)] = prog
+            metrics.observe("download_queue_depth", len(waiting))
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                prog = running.pop(future)
+                try:
+                    downloaded += future.result() or 0
+                except Exception as exc:
+                    print(f"{prog['name']} generated an exception: {exc}")
+    if waiting:
+        # Left for "Retry failed downloads"
+        reason = limit_reached()
+        print(f"{Yellow}[!]{White} {len(waiting)} programs deferred ({reason}), use \"Retry failed downloads\" to fetch them")
+        for prog in waiting:
+            record_failed_download(prog["name"], save_dir, f"deferred: {reason}")
+        metrics.count("programs_deferred", len(waiting))
+    finish_run(run_id).result()
+    if STORE_DIR:
+        write_view(save_dir, [p["name"] for p in programs], update=resume)
+    with metrics.timer("master"):
+        run_profiled(build_master_files, save_dir)
+    if prober:
+        prober.close()
+    print_metrics(metrics.write())
+    if not prober and interactive:
+        ask(save_dir)
+
+def print_metrics(summary):
+    from tabulate import tabulate
+    rows = [
+        [stage, t["seconds"], t["items"], t["items_per_sec"], t["mb_per_sec"]]
+        for stage, t in summary["stages"].items()
+    ]
+    print(tabulate(rows, headers=["stage", "busy s", "items", "items/s", "MB/s"], tablefmt="simple"))
+    print(f"Peak RSS {summary['peak_rss_mb']} MB, " + ", ".join(f"max {k} {v}" for k, v in summary["gauges"].items()))
+
+def download_query(expression, save_dir, probe_tool=STREAM_PROBE, interactive=True, force=False):
+    download_programs(get_catalog().select(expression), save_dir, probe_tool, interactive, force=force)
+
+def retry_failed_downloads(interactive=True):
+    failed = get_failed_downloads()
+    if not failed:
+        print("No failed downloads to retry.")
+        return
+    for save_dir, names in failed.items():
+        programs = [get_catalog().get(n) for n in names]
+        download_programs([p for p in programs if p], save_dir, interactive=interactive, resume=True)
 
 def download_specific_program(program_name):
+    from tabulate import tabulate
     base_dir = program_name
-    programs = [p for p in data_json if p["name"] == program_name]
-    if programs:
-        p = programs[0]
+    p = get_catalog().get(program_name)
+    if p:
         info_table = [
             ["name", p['name']],
             ["program url", p['URL']],
@@ -272,35 +1924,419 @@ def download_specific_program(program_name):
             ["last_updated", p['last_updated'][:10]]
         ]
         print(tabulate(info_table, headers=["Info", program_name], tablefmt="double_grid"))
-        download_filtered_programs(lambda p: p["name"] == program_name, base_dir)
+        download_programs([p], base_dir)
     else:
         print("Program not found.")
 
+##########################################
+# Merging shard databases
+##########################################
+def merge_shard(path, save_dir):
+    # Folds one shard database into chaos.db as a run of its own; returns (run ID, added, removed)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    get_db_writer()
+    # Opened before this run is added, so it still matches chaos.db
+    known = get_known_filter()
+    conn = connect_db()
+    try:
+        conn.execute("ATTACH DATABASE ? AS shard;", (str(path),))
+        version = conn.execute("PRAGMA shard.user_version;").fetchone()[0]
+        if version != len(MIGRATIONS):
+            raise ValueError(f"{path} has schema v{version}, expected v{len(MIGRATIONS)}; open it with this version once first")
+        conn.execute("BEGIN IMMEDIATE;")
+        run_id = conn.execute(
+            "INSERT INTO main.runs(save_dir, started_at, programs) "
+            "SELECT ?, DATETIME('NOW'), count(DISTINCT program_ID) FROM shard.program_runs;",
+            (save_dir,)
+        ).lastrowid
+        conn.execute(
+            "INSERT OR IGNORE INTO main.names(name, platform, offer_bounty, late_update) "
+            "SELECT name, platform, offer_bounty, late_update FROM shard.names;"
+        )
+        # Only programs the shard ingested completely speak for their subdomain lists
+        conn.execute(
+            "CREATE TEMP TABLE merged_programs AS SELECT n.ID AS main_ID, sn.ID AS shard_ID "
+            "FROM shard.names sn JOIN main.names n ON n.name=sn.name "
+            "WHERE sn.ID IN (SELECT program_ID FROM shard.program_runs);"
+        )
+        # Their current lists: the names they own in the shard and the ones they share there
+        conn.execute("CREATE TEMP TABLE merged_lists (subdomain TEXT, program_ID INTEGER, PRIMARY KEY(subdomain, program_ID)) WITHOUT ROWID;")
+        conn.execute("CREATE TEMP TABLE merged_new (subdomain TEXT PRIMARY KEY, program_ID INTEGER) WITHOUT ROWID;")
+        conn.execute("CREATE TEMP TABLE merged_removed (subdomain TEXT PRIMARY KEY, program_ID INTEGER) WITHOUT ROWID;")
+        conn.execute(
+            "INSERT OR IGNORE INTO temp.merged_lists SELECT s.subdomain, m.main_ID FROM shard.subdomains s "
+            "JOIN temp.merged_programs m ON m.shard_ID=s.program_ID WHERE s.removed IS NULL "
+            "UNION ALL SELECT x.subdomain, m.main_ID FROM shard.shared_subdomains x "
+            "JOIN temp.merged_programs m ON m.shard_ID=x.program_ID;"
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO temp.merged_new SELECT l.subdomain, l.program_ID FROM temp.merged_lists l WHERE NOT EXISTS "
+            "(SELECT 1 FROM main.subdomains d WHERE d.subdomain=l.subdomain AND d.removed IS NULL);"
+        )
+        conn.execute(
+            "INSERT INTO main.subdomains(subdomain, rname, program_ID, first_seen) "
+            "SELECT subdomain, reverse_labels(subdomain), program_ID, ? "
+            "FROM temp.merged_new WHERE true "
+            "ON CONFLICT(subdomain) DO UPDATE SET program_ID=excluded.program_ID, removed=NULL WHERE removed IS NOT NULL;",
+            (run_id,)
+        )
+        conn.execute("DELETE FROM main.shared_subdomains WHERE program_ID IN (SELECT main_ID FROM temp.merged_programs);")
+        conn.execute(
+            "INSERT OR IGNORE INTO main.shared_subdomains SELECT l.subdomain, l.program_ID FROM temp.merged_lists l "
+            "JOIN main.subdomains d ON d.subdomain=l.subdomain AND d.removed IS NULL AND d.program_ID != l.program_ID;"
+        )
+        conn.execute(
+            "INSERT INTO temp.merged_removed SELECT d.subdomain, d.program_ID FROM main.subdomains d "
+            "JOIN temp.merged_programs m ON m.main_ID=d.program_ID WHERE d.removed IS NULL AND NOT EXISTS "
+            "(SELECT 1 FROM temp.merged_lists l WHERE l.subdomain=d.subdomain AND l.program_ID=d.program_ID);"
+        )
+        # As in mark_removed(): names another program still lists move to it instead
+        conn.execute(
+            "UPDATE main.subdomains SET program_ID=(SELECT max(x.program_ID) FROM main.shared_subdomains x WHERE x.subdomain=subdomains.subdomain) "
+            "WHERE subdomain IN (SELECT subdomain FROM temp.merged_removed) "
+            "AND subdomain IN (SELECT subdomain FROM main.shared_subdomains);"
+        )
+        conn.execute(
+            "DELETE FROM temp.merged_removed WHERE program_ID != "
+            "(SELECT d.program_ID FROM main.subdomains d WHERE d.subdomain=merged_removed.subdomain);"
+        )
+        conn.execute(
+            "DELETE FROM main.shared_subdomains WHERE program_ID="
+            "(SELECT d.program_ID FROM main.subdomains d WHERE d.subdomain=shared_subdomains.subdomain);"
+        )
+        conn.execute(
+            "UPDATE main.subdomains SET removed=? WHERE subdomain IN (SELECT subdomain FROM temp.merged_removed);",
+            (run_id,)
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO main.subdomain_events(subdomain, run_ID, added) "
+            "SELECT subdomain, ?1, 1 FROM temp.merged_new UNION ALL SELECT subdomain, ?1, 0 FROM temp.merged_removed;",
+            (run_id,)
+        )
+        conn.execute("INSERT OR IGNORE INTO main.program_runs SELECT main_ID, ? FROM temp.merged_programs;", (run_id,))
+        # Later single-process runs can then skip what the shard already fetched
+        conn.execute("INSERT OR REPLACE INTO main.http_cache SELECT * FROM shard.http_cache WHERE last_updated IS NOT NULL;")
+        conn.execute("INSERT OR REPLACE INTO main.probes SELECT * FROM shard.probes;")
+        conn.execute(
+            "DELETE FROM main.failed_downloads WHERE name IN "
+            "(SELECT n.name FROM main.names n JOIN temp.merged_programs m ON m.main_ID=n.ID);"
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO main.failed_downloads(name, save_dir, error, attempts, failed_at) "
+            "SELECT name, ?, error, attempts, failed_at FROM shard.failed_downloads;",
+            (save_dir,)
+        )
+        conn.execute(
+            "UPDATE main.runs SET finished_at=DATETIME('NOW'), added=(SELECT count(*) FROM temp.merged_new), "
+            "removed=(SELECT count(*) FROM temp.merged_removed) WHERE ID=?;",
+            (run_id,)
+        )
+        conn.execute("COMMIT;")
+
+        added = removed = 0
+        rows = conn.execute("SELECT subdomain FROM temp.merged_new;")
+        while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+            names = [r[0] for r in chunk]
+            write_lines(f"new_{save_dir}.txt", names)
+            if MASTER_FILES:
+                write_lines(f"{save_dir}.txt.incoming", names)
+            if known is not None:
+                known.add_many(names)
+            added += len(names)
+        rows = conn.execute("SELECT subdomain FROM temp.merged_removed;")
+        while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+            if TRACK_REMOVED:
+                write_lines(f"removed_{save_dir}.txt", [r[0] for r in chunk])
+            removed += len(chunk)
+        if known is not None:
+            known.sync(run_id)
+        return run_id, added, removed
+    finally:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK;")
+        conn.close()
+
+def merge_shards(paths, save_dir="all_programmes"):
+    # new_<dir>.txt gets the names that are new to chaos.db across all shards
+    for path in (f"new_{save_dir}.txt", f"removed_{save_dir}.txt"):
+        if os.path.exists(path):
+            os.remove(path)
+    for path in paths:
+        with metrics.timer("merge") as stats:
+            run_id, added, removed = merge_shard(path, save_dir)
+            stats["items"] = added
+        print(f"{Green}[\u2713]{White} {path}: run #{run_id}, {added} new, {removed} removed")
+    build_master_files(save_dir)
+
 ##########################################
 # Functions for external commands & export
 ##########################################
+PROBE_TOOLS = {
+    "httprobe": ["httprobe", "-c", "1000"],
+    "httpx":    ["httpx", "-t", "200", "-silent", "-nc", "-rl", "600"],
+}
+
+class StreamingProber:
+    """Long-running httprobe/httpx process fed with subdomains as they arrive.
+
+    Batches pass through a bounded queue to a feeder thread writing the
+    tool's stdin, so a slow prober holds back the ingest workers instead of
+    buffering without limit. A reader thread appends every live host to
+    live_domains_<dir>_<tool>.txt as soon as the tool prints it.
+    """
+
+    def __init__(self, tool, first_dir):
+        self.output_path = f"live_domains_{first_dir}_{tool}.txt"
+        self.process = subprocess.Popen(
+            PROBE_TOOLS[tool], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1
+        )
+        with open(self.output_path, "w", encoding="utf-8") as f:
+            pass  # Truncate file first
+        self.queue = queue.Queue(maxsize=PROBE_QUEUE_SIZE)
+        self.started, self.probed, self.live = time.perf_counter(), 0, 0
+        self.feeder = threading.Thread(target=self.feed_stdin, daemon=True)
+        self.reader = threading.Thread(target=self.read_stdout, daemon=True)
+        self.feeder.start()
+        self.reader.start()
+
+    def submit(self, subdomains):
+        self.queue.put(subdomains)
+
+    def feed_stdin(self):
+        broken = False
+        while (batch := self.queue.get()) is not None:
+            if broken:
+                continue  # Keep draining so submit() never blocks on a dead prober
+            self.probed += len(batch)
+            try:
+                self.process.stdin.write("\n".join(batch) + "\n")
+                self.process.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                broken = True
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def read_stdout(self):
+        with open(self.output_path, "a", encoding="utf-8") as out:
+            for line in self.process.stdout:
+                print(line, end='')
+                out.write(line)
+                out.flush()
+                self.live += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.feeder.join()
+        self.process.wait()
+        self.reader.join()
+        metrics.record("probe", time.perf_counter() - self.started, self.probed)
+        metrics.count("probe_live", self.live)
+
+class NativeProber:
+    """Built-in asyncio HTTP/HTTPS liveness prober.
+
+    Same submit()/close() interface as StreamingProber. An event loop in a
+    background thread probes https first and falls back to http, with a cap
+    on hosts in flight, a per-IP connection rate limit and lookups of the
+    same name shared while they are in flight. Live hosts are appended to
+    live_domains_<dir>_builtin.txt and their status codes stored in the
+    probes table.
+    """
+
+    FLUSH_SIZE = 500
+
+    def __init__(self, first_dir, concurrency=PROBE_CONCURRENCY, timeout=PROBE_TIMEOUT, host_rate=PROBE_HOST_RATE):
+        self.output_path = f"live_domains_{first_dir}_builtin.txt"
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.host_rate = host_rate
+        with open(self.output_path, "w", encoding="utf-8") as f:
+            pass  # Truncate file first
+        # Liveness only: certificates are not verified, like httprobe/httpx
+        import_network_modules()
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.queue = queue.Queue(maxsize=PROBE_QUEUE_SIZE)
+        self.started, self.probed, self.live = time.perf_counter(), 0, 0
+        self.thread = threading.Thread(target=lambda: asyncio.run(self.run()), daemon=True)
+        self.thread.start()
+
+    def submit(self, subdomains):
+        self.queue.put(subdomains)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        metrics.record("probe", time.perf_counter() - self.started, self.probed)
+        metrics.count("probe_live", self.live)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(self.concurrency)
+        self.lookups = {}
+        self.next_connect = {}
+        self.sweep_at = self.concurrency
+        self.results = []
+        tasks = set()
+        while (batch := await loop.run_in_executor(None, self.queue.get)) is not None:
+            for host in batch:
+                # Waiting for a free slot here keeps the number of pending tasks bounded
+                await self.slots.acquire()
+                self.probed += 1
+                task = asyncio.create_task(self.probe_host(host))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        await loop.run_in_executor(None, self.flush, self.results)
+
+    async def probe_host(self, host):
+        try:
+            address = await self.resolve(host)
+            if address is None:
+                return
+            for scheme, port in (("https", 443), ("http", 80)):
+                status = await self.request(host, address, scheme, port)
+                if status is not None:
+                    url = f"{scheme}://{host}"
+                    print(f"{url} [{status}]")
+                    self.live += 1
+                    self.results.append((host, url, status))
+                    if len(self.results) >= self.FLUSH_SIZE:
+                        results, self.results = self.results, []
+                        await asyncio.get_running_loop().run_in_executor(None, self.flush, results)
+                    return
+        finally:
+            self.slots.release()
+
+    async def resolve(self, host):
+        # Concurrent lookups of the same name share one future. Every host is probed once, so finished
+        # lookups would never be asked for again; dropping them keeps memory flat over millions of hosts.
+        future = self.lookups.get(host)
+        if future is None:
+            future = self.lookups[host] = asyncio.ensure_future(self.lookup(host))
+            future.add_done_callback(lambda _: self.lookups.pop(host, None))
+        return await future
+
+    async def lookup(self, host):
+        try:
+            infos = await asyncio.wait_for(
+                asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM), self.timeout
+            )
+        except (OSError, asyncio.TimeoutError, UnicodeError):
+            return None
+        return infos[0][4][0] if infos else None
+
+    async def wait_turn(self, address):
+        # Space connections to the same IP so shared CDN/load-balancer addresses are not hammered
+        if self.host_rate <= 0:
+            return
+        now = asyncio.get_running_loop().time()
+        if len(self.next_connect) >= self.sweep_at:
+            # A slot in the past is as good as none; keep only the addresses still spacing connections
+            self.next_connect = {a: t for a, t in self.next_connect.items() if t > now}
+            self.sweep_at = max(self.concurrency, 2 * len(self.next_connect))
+        slot = max(now, self.next_connect.get(address, now))
+        self.next_connect[address] = slot + 1 / self.host_rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def request(self, host, address, scheme, port):
+        # Returns the HTTP status code, or None if nothing answered
+        await self.wait_turn(address)
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    address, port,
+                    ssl=self.ssl_context if scheme == "https" else None,
+                    server_hostname=host if scheme == "https" else None,
+                ),
+                self.timeout,
+            )
+        except (OSError, asyncio.TimeoutError, ssl.SSLError, ValueError):
+            return None
+        try:
+            writer.write(
+                f"GET / HTTP/1.1\r\nHost: {host}\r\nUser-Agent: Mozilla/5.0\r\nConnection: close\r\n\r\n".encode()
+            )
+            await writer.drain()
+            status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+        except (OSError, asyncio.TimeoutError, ssl.SSLError):
+            return None
+        finally:
+            writer.close()
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+        parts = status_line.split()
+        if len(parts) >= 2 and parts[0].startswith(b"HTTP/") and parts[1].isdigit():
+            return int(parts[1])
+        return None
+
+    def flush(self, results):
+        if not results:
+            return
+        write_lines(self.output_path, [url for _, url, _ in results])
+        get_db_writer().submit(store_probe_results, results)
+
+def store_probe_results(conn, results):
+    conn.executemany(
+        "INSERT OR REPLACE INTO probes(subdomain, url, status, probed_at) VALUES(?, ?, ?, DATETIME('NOW'));",
+        results
+    )
+
+def make_prober(tool, first_dir):
+    if tool == "builtin":
+        return NativeProber(first_dir)
+    return StreamingProber(tool, first_dir)
+
+def probe_file(tool, file_name):
+    prober = make_prober(tool, file_name)
+    with open(f"new_{file_name}.txt", encoding="utf-8") as f:
+        for chunk in iter_chunks(line.strip() for line in f):
+            prober.submit(chunk)
+    prober.close()
+    metrics.write()
+
+def probe_database(tool, first_dir, program_names=None):
+    # Probe every current subdomain, optionally only those of the given programs
+    prober = make_prober(tool, first_dir)
+    conn = get_connection()
+    if program_names is None:
+        rows = conn.execute("SELECT subdomain FROM subdomains WHERE removed IS NULL;")
+    else:
+        # UNION: a name several of the programs list is probed once
+        rows = conn.execute(
+            "SELECT s.subdomain FROM names n JOIN subdomains s ON s.program_ID=n.ID "
+            "WHERE n.name IN (SELECT value FROM json_each(?1)) AND s.removed IS NULL "
+            "UNION SELECT m.subdomain FROM names n JOIN shared_subdomains m ON m.program_ID=n.ID "
+            "WHERE n.name IN (SELECT value FROM json_each(?1));",
+            (json.dumps(list(program_names)),)
+        )
+    while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+        prober.submit([r[0] for r in chunk])
+    prober.close()
+    metrics.write()
+
 def httprobe_command(file_name):
-    cmd = f'cat "new_{file_name}.txt" | httprobe -c 1000 | tee -a "live_domains_{file_name}_httprobe.txt"'
-    with open(f"live_domains_{file_name}_httprobe.txt", "w", encoding="utf-8") as f:
-        pass  # Truncate file first
-    p1 = subprocess.Popen(cmd, shell=True, text=True, stdout=subprocess.PIPE, bufsize=1)
-    for line in p1.stdout:
-        print(line, end='')
+    probe_file("httprobe", file_name)
 
 def httpx_command(file_name):
-    cmd = f'cat "new_{file_name}.txt" | httpx -t 200 -silent -nc -rl 600 | tee -a "live_domains_{file_name}_httpx.txt"'
-    with open(f"live_domains_{file_name}_httpx.txt", "w", encoding="utf-8") as f:
-        pass
-    p1 = subprocess.Popen(cmd, shell=True, text=True, stdout=subprocess.PIPE, bufsize=1)
-    for line in p1.stdout:
-        print(line, end='')
+    probe_file("httpx", file_name)
 
 def ask(first_dir):
+    from simple_term_menu import TerminalMenu
     print("\n")
-    options = ["httprobe", "httpx", "Back to Main Menu", "Exit"]
+    if not os.path.exists(f"new_{first_dir}.txt"):
+        print("No new subdomains to probe.")
+        return
+    options = ["httprobe", "httpx", "built-in prober", "Back to Main Menu", "Exit"]
     menu = TerminalMenu(
         options,
-        title="Do you want to use httprobe or httpx?",
+        title="Do you want to use httprobe, httpx or the built-in prober?",
         menu_cursor=main_menu_cursor,
         menu_cursor_style=main_menu_cursor_style,
         menu_highlight_style=main_menu_style
@@ -311,13 +2347,70 @@ def ask(first_dir):
     elif choice == 1:
         httpx_command(first_dir)
     elif choice == 2:
+        probe_file("builtin", first_dir)
+    elif choice == 3:
         return
     else:
         exit(0)
 
+EXPORT_FORMATS = ("txt", "jsonl", "csv")
+
+def export_path(name, fmt="txt", compress=False):
+    return f"{name}_exported.{fmt}" + (".gz" if compress else "")
+
+def write_export_rows(f, fmt, rows):
+    # rows are (subdomain, program, platform, bounty); txt keeps the plain one-name-per-line layout
+    if fmt == "txt":
+        f.write("".join(r[0] + "\n" for r in rows))
+    elif fmt == "jsonl":
+        f.write("".join(
+            json.dumps({"subdomain": r[0], "program": r[1], "platform": r[2], "bounty": bool(r[3])}) + "\n"
+            for r in rows
+        ))
+    else:
+        csv.writer(f, lineterminator="\n").writerows((r[0], r[1], r[2], bool(r[3])) for r in rows)
+
+def export_query(program_names, path, fmt="txt"):
+    # Streams the subdomains of the given programs into path; returns the number of rows
+    count = 0
+    # Each program's own list: the names it owns and the ones it shares with their owner
+    query = (
+        "SELECT s.subdomain, n.name, n.platform, n.offer_bounty FROM names n "
+        "JOIN subdomains s ON s.program_ID=n.ID WHERE n.name IN (SELECT value FROM json_each(?1)) AND s.removed IS NULL "
+        "UNION ALL SELECT m.subdomain, n.name, n.platform, n.offer_bounty FROM names n "
+        "JOIN shared_subdomains m ON m.program_ID=n.ID WHERE n.name IN (SELECT value FROM json_each(?1))"
+    )
+    if fmt == "txt" and len(program_names) > 1:
+        # Without a program column a name several of them list would repeat
+        query = f"SELECT DISTINCT subdomain, NULL, NULL, NULL FROM ({query})"
+    rows = get_connection().execute(query + ";", (json.dumps(list(program_names)),))
+    with open_text(path, "w") as f:
+        if fmt == "csv":
+            f.write("subdomain,program,platform,bounty\n")
+        while chunk := rows.fetchmany(INGEST_CHUNK_SIZE):
+            write_export_rows(f, fmt, chunk)
+            count += len(chunk)
+    return count
+
+def export_programs(program_names, fmt="txt", compress=False, combined=None, workers=EXPORT_WORKERS):
+    # One file per program, exported concurrently, or a single combined file; returns [(path, rows)]
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {fmt!r}")
+    if combined:
+        path = export_path(combined, fmt, compress)
+        return [(path, export_query(program_names, path, fmt))]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            (path, executor.submit(export_query, [name], path, fmt))
+            for name in program_names
+            for path in [export_path(name, fmt, compress)]
+        ]
+        return [(path, future.result()) for path, future in futures]
+
 def export_programme():
+    from simple_term_menu import TerminalMenu
     try:
-        programme_names = [p["name"] for p in data_json]
+        programme_names = get_catalog().names()
         export_menu = TerminalMenu(
             programme_names,
             title=main_menu_title + "  Export Menu.\n  Press Q or Esc to back to main menu. \n",
@@ -329,17 +2422,26 @@ def export_programme():
             show_multi_select_hint=True
         )
         _ = export_menu.show()
-        for prog in export_menu.chosen_menu_entries:
-            with sqlite_lock:
-                cursor.execute("SELECT ID FROM names WHERE name=?", (prog,))
-                row = cursor.fetchone()
-                if row:
-                    program_id = row[0]
-                    cursor.execute("SELECT subdomain FROM subdomains WHERE program_ID=?", (program_id,))
-                    subdomains = [r[0] for r in cursor.fetchall()]
-            with open(f"{prog}_exported.txt", "w", encoding="utf-8") as file:
-                for sd in subdomains:
-                    file.write(sd + "\n")
+        chosen = export_menu.chosen_menu_entries
+        if not chosen:
+            return
+        format_options = [f"{fmt}{suffix}" for suffix in ("", " (gzip)") for fmt in EXPORT_FORMATS]
+        format_menu = TerminalMenu(
+            format_options + ["one combined txt file", "one combined jsonl file", "one combined csv file"],
+            title="  Export format",
+            menu_cursor=main_menu_cursor,
+            menu_cursor_style=main_menu_cursor_style,
+            menu_highlight_style=main_menu_style
+        )
+        f_choice = format_menu.show()
+        if f_choice is None:
+            return
+        if f_choice < len(format_options):
+            fmt, compress, combined = EXPORT_FORMATS[f_choice % len(EXPORT_FORMATS)], f_choice >= len(EXPORT_FORMATS), None
+        else:
+            fmt, compress, combined = EXPORT_FORMATS[f_choice - len(format_options)], False, "combined"
+        for path, count in export_programs(chosen, fmt, compress, combined):
+            print(f"{Red}[+]{White} {path}: {count} subdomains {Green}[\u2713]{White}")
     except Exception as e:
         print(e)
 
@@ -374,14 +2476,80 @@ main_menu_items = [
     "specific programs",
     "Info about programs",
     "Export programme from database",
+    "Retry failed downloads",
+    "Run history",
+    "Database maintenance",
     "Quit"
 ]
 
+# Catalog query and output directory for the download entries of the main menu.
+# Entries with {platform} ask for a platform first ("" is self hosted).
+main_menu_queries = {
+    0:  ("all", "all_programmes"),
+    1:  ("bounty", "offer_bounty"),
+    2:  ("!bounty", "not_offer_bounty"),
+    3:  ("platform={platform}", "{platform_dir}"),
+    4:  ("changed", "new_subdomains"),
+    5:  ("changed&bounty", "new_subdomains_and_offer_bounty"),
+    6:  ("changed&bounty&platform={platform}", "new_subdomain_and_offer_bounty_and_{platform_dir}"),
+    7:  ("changed&platform={platform}", "new_subdomain_and_platform_{platform_dir}"),
+    8:  ("changed&!bounty", "new_subdomain_and_not_offer_bounty"),
+    9:  ("changed&!bounty&platform={platform}", "new_subdomain_and_not_offer_bounty_and_{platform_dir}"),
+    10: ("bounty&platform={platform}", "offer_bounty_and_{platform_dir}"),
+    11: ("!bounty&platform={platform}", "not_offer_bounty_and_{platform_dir}"),
+}
+
 main_menu_cursor = "> "
 main_menu_cursor_style = ("fg_red", "bold")
 main_menu_style = ("bg_red", "fg_yellow")
 
+def run_history():
+    # Pick a run and write what changed since the run before it
+    from simple_term_menu import TerminalMenu
+    runs = get_runs()
+    if not runs:
+        print("No runs recorded yet.")
+        return
+    options = [
+        f"#{run_id} {started} {save_dir} ({programs} programs, +{added or 0} -{removed or 0})"
+        for run_id, save_dir, started, _, programs, added, removed in runs
+    ]
+    history_menu = TerminalMenu(
+        options,
+        title=main_menu_title + "  Run History. Pick a run to write its changes to run_<ID>_diff.txt\n  Press Q or Esc to back to main menu. \n",
+        menu_cursor=main_menu_cursor,
+        menu_cursor_style=main_menu_cursor_style,
+        menu_highlight_style=main_menu_style
+    )
+    choice = history_menu.show()
+    if choice is None:
+        return
+    run_id = runs[choice][0]
+    path = f"run_{run_id}_diff.txt"
+    added, removed = write_run_diff(run_id - 1, run_id, path)
+    print(f"{Green}[\u2713]{White} {path}: {added} added, {removed} removed")
+
+def choose_platform():
+    # Returns the platform name, "" for self hosted, or None to go back
+    from simple_term_menu import TerminalMenu
+    platform_options = ["Hackerone", "Bugcrowd", "Yeswehack", "Self hosted", "Back to Main Menu"]
+    plat_menu = TerminalMenu(
+        platform_options,
+        title=main_menu_title + "  Platform Menu.\n  Press Q or Esc to back to main menu. \n",
+        menu_cursor=main_menu_cursor,
+        menu_cursor_style=main_menu_cursor_style,
+        menu_highlight_style=main_menu_style,
+        cycle_cursor=True,
+        clear_screen=True,
+    )
+    p_choice = plat_menu.show()
+    if p_choice in [0, 1, 2, 3]:
+        plat = platform_options[p_choice]
+        return "" if plat.lower() == "self hosted" else plat
+    return None
+
 def main():
+    from simple_term_menu import TerminalMenu
     main_menu = TerminalMenu(
         menu_entries=main_menu_items,
         title=main_menu_title + "  Main Menu.\n  Press Q or Esc to back to main menu. \n",
@@ -393,122 +2561,17 @@ def main():
     )
     while True:
         choice = main_menu.show()
-        if choice == 0:
-            download_all_programmes()
-        elif choice == 1:
-            download_offer_bounty()
-        elif choice == 2:
-            download_not_offer_bounty()
-        elif choice == 3:
-            platform_options = ["Hackerone", "Bugcrowd", "Yeswehack", "Self hosted", "Back to Main Menu"]
-            plat_menu = TerminalMenu(
-                platform_options,
-                title=main_menu_title + "  Platform Menu.\n  Press Q or Esc to back to main menu. \n",
-                menu_cursor=main_menu_cursor,
-                menu_cursor_style=main_menu_cursor_style,
-                menu_highlight_style=main_menu_style,
-                cycle_cursor=True,
-                clear_screen=True,
-            )
-            p_choice = plat_menu.show()
-            if p_choice in [0, 1, 2, 3]:
-                plat = platform_options[p_choice]
-                if plat.lower() == "self hosted":
-                    plat = ""
-                download_by_platform(plat)
-        elif choice == 4:
-            download_new_subdomain()
-        elif choice == 5:
-            new_subdomains_and_offer_bounty()
-        elif choice == 6:
-            platform_options = ["Hackerone", "Bugcrowd", "Yeswehack", "Self hosted", "Back to Main Menu"]
-            plat_menu = TerminalMenu(
-                platform_options,
-                title=main_menu_title + "  Platform Menu.\n  Press Q or Esc to back to main menu. \n",
-                menu_cursor=main_menu_cursor,
-                menu_cursor_style=main_menu_cursor_style,
-                menu_highlight_style=main_menu_style,
-                cycle_cursor=True,
-                clear_screen=True,
-            )
-            p_choice = plat_menu.show()
-            if p_choice in [0, 1, 2, 3]:
-                plat = platform_options[p_choice]
-                if plat.lower() == "self hosted":
-                    plat = ""
-                new_subdomain_and_offer_bounty_and_platform(plat)
-        elif choice == 7:
-            platform_options = ["Hackerone", "Bugcrowd", "Yeswehack", "Self hosted", "Back to Main Menu"]
-            plat_menu = TerminalMenu(
-                platform_options,
-                title=main_menu_title + "  Platform Menu.\n  Press Q or Esc to back to main menu. \n",
-                menu_cursor=main_menu_cursor,
-                menu_cursor_style=main_menu_cursor_style,
-                menu_highlight_style=main_menu_style,
-                cycle_cursor=True,
-                clear_screen=True,
-            )
-            p_choice = plat_menu.show()
-            if p_choice in [0, 1, 2, 3]:
-                plat = platform_options[p_choice]
-                if plat.lower() == "self hosted":
-                    plat = ""
-                new_subdomain_and_platform(plat)
-        elif choice == 8:
-            new_subdomain_and_not_offer_bounty()
-        elif choice == 9:
-            platform_options = ["Hackerone", "Bugcrowd", "Yeswehack", "Self hosted", "Back to Main Menu"]
-            plat_menu = TerminalMenu(
-                platform_options,
-                title=main_menu_title + "  Platform Menu.\n  Press Q or Esc to back to main menu. \n",
-                menu_cursor=main_menu_cursor,
-                menu_cursor_style=main_menu_cursor_style,
-                menu_highlight_style=main_menu_style,
-                cycle_cursor=True,
-                clear_screen=True,
-            )
-            p_choice = plat_menu.show()
-            if p_choice in [0, 1, 2, 3]:
-                plat = platform_options[p_choice]
-                if plat.lower() == "self hosted":
-                    plat = ""
-                new_subdomain_and_not_offer_bounty_and_platform(plat)
-        elif choice == 10:
-            platform_options = ["Hackerone", "Bugcrowd", "Yeswehack", "Self hosted", "Back to Main Menu"]
-            plat_menu = TerminalMenu(
-                platform_options,
-                title=main_menu_title + "  Platform Menu.\n  Press Q or Esc to back to main menu. \n",
-                menu_cursor=main_menu_cursor,
-                menu_cursor_style=main_menu_cursor_style,
-                menu_highlight_style=main_menu_style,
-                cycle_cursor=True,
-                clear_screen=True,
-            )
-            p_choice = plat_menu.show()
-            if p_choice in [0, 1, 2, 3]:
-                plat = platform_options[p_choice]
-                if plat.lower() == "self hosted":
-                    plat = ""
-                offer_bounty_and_platform(plat)
-        elif choice == 11:
-            platform_options = ["Hackerone", "Bugcrowd", "Yeswehack", "Self hosted", "Back to Main Menu"]
-            plat_menu = TerminalMenu(
-                platform_options,
-                title=main_menu_title + "  Platform Menu.\n  Press Q or Esc to back to main menu. \n",
-                menu_cursor=main_menu_cursor,
-                menu_cursor_style=main_menu_cursor_style,
-                menu_highlight_style=main_menu_style,
-                cycle_cursor=True,
-                clear_screen=True,
-            )
-            p_choice = plat_menu.show()
-            if p_choice in [0, 1, 2, 3]:
-                plat = platform_options[p_choice]
-                if plat.lower() == "self hosted":
-                    plat = ""
-                not_offer_bounty_and_platform(plat)
+        if choice in main_menu_queries:
+            query, save_dir = main_menu_queries[choice]
+            if "{platform}" in query:
+                plat = choose_platform()
+                if plat is None:
+                    continue
+                query = query.format(platform=plat)
+                save_dir = save_dir.format(platform_dir=plat if plat else "self_hosted")
+            download_query(query, save_dir)
         elif choice == 12:
-            prog_options = [p["name"] for p in data_json]
+            prog_options = get_catalog().names()
             prog_menu = TerminalMenu(
                 prog_options,
                 title=main_menu_title + "  Programs Menu.\n  Press Q or Esc to back to main menu. \n",
@@ -524,31 +2587,20 @@ def main():
                 download_specific_program(prog)
         elif choice == 13:
             # Info menu
-            last_update = data_json[0]['last_updated'][:10]
-            total_subdomains = sum(p["count"] for p in data_json)
-            programs_changed = sum(1 for p in data_json if p["change"] != 0)
-            new_programs = sum(1 for p in data_json if p["is_new"] == True)
-            hackerone_programs = sum(1 for p in data_json if p["platform"].lower() == "hackerone")
-            bugcrowd_programs = sum(1 for p in data_json if p["platform"].lower() == "bugcrowd")
-            yeswehacker_programs = sum(1 for p in data_json if p["platform"].lower() == "yeswehack")
-            self_hosted_programs = sum(1 for p in data_json if p["platform"] == "")
-            programs_with_rewards = sum(1 for p in data_json if p["bounty"] == True)
-            programs_with_no_rewards = sum(1 for p in data_json if p["bounty"] == False)
-            programs_with_swag = sum(1 for p in data_json if 'swag' in p)
-
+            stats = get_catalog().stats
             info_options = [
-                f"Programs last updated in {last_update}",
-                f"{total_subdomains} Subdomains.",
-                f"{len(data_json)} Programs.",
-                f"{programs_changed} Programs changed.",
-                f"{new_programs} New programs.",
-                f"{hackerone_programs} Hackerone programs.",
-                f"{bugcrowd_programs} Bugcrowd programs.",
-                f"{yeswehacker_programs} Yeswehack programs.",
-                f"{self_hosted_programs} Self hosted programs.",
-                f"{programs_with_rewards} Programs with rewards.",
-                f"{programs_with_swag} Programs offer swags.",
-                f"{programs_with_no_rewards} No rewards programs.",
+                f"Programs last updated in {stats['last_update']}",
+                f"{stats['subdomains']} Subdomains.",
+                f"{stats['programs']} Programs.",
+                f"{stats['changed']} Programs changed.",
+                f"{stats['new']} New programs.",
+                f"{stats['hackerone']} Hackerone programs.",
+                f"{stats['bugcrowd']} Bugcrowd programs.",
+                f"{stats['yeswehack']} Yeswehack programs.",
+                f"{stats['self_hosted']} Self hosted programs.",
+                f"{stats['bounty']} Programs with rewards.",
+                f"{stats['swag']} Programs offer swags.",
+                f"{stats['no_bounty']} No rewards programs.",
                 "Back to Main Menu",
                 "Exit"
             ]
@@ -565,9 +2617,221 @@ def main():
         elif choice == 14:
             export_programme()
         elif choice == 15:
+            retry_failed_downloads()
+        elif choice == 16:
+            run_history()
+        elif choice == 17:
+            print("Running ANALYZE and VACUUM, this can take a while on big databases...")
+            size_before, size_after = maintain_database(vacuum=True)
+            print(f"{Green}[\u2713]{White} {DB_PATH}: {size_before / 1048576:.1f} MB -> {size_after / 1048576:.1f} MB")
+            removed, freed = prune_store()
+            if removed:
+                print(f"{Green}[\u2713]{White} {STORE_DIR}: removed {removed} unreferenced zips ({freed / 1048576:.1f} MB)")
+        elif choice == 18:
             print("Quit Selected")
             break
 
+##########################################
+# Non-interactive command line
+##########################################
+# Every command returns the process exit code. Only the ones that need the
+# program list fetch index.json, and only the menus load the terminal UI.
+def default_save_dir(query):
+    # The main menu's directory for the same query, otherwise one named after the query
+    for menu_query, save_dir in main_menu_queries.values():
+        if menu_query == query:
+            return save_dir
+    return re.sub(r"[^\w.-]+", "_", query.replace("!", "not_")).strip("_") or "all_programmes"
+
+def parse_run(value):
+    # A run ID, or a "YYYY-MM-DD[ HH:MM:SS]" date for the latest run started by then
+    if value.isdigit():
+        return int(value)
+    run_id = find_run(value)
+    if run_id is None:
+        raise SystemExit(f"No run started on or before {value}")
+    return run_id
+
+def command_sync(args):
+    download_query(args.query, args.dir or default_save_dir(args.query), args.probe, interactive=False, force=args.force)
+    return 1 if metrics.counters["programs_failed"] else 0
+
+def command_retry(args):
+    retry_failed_downloads(interactive=False)
+    return 1 if metrics.counters["programs_failed"] else 0
+
+def command_filter(args):
+    for p in get_catalog().select(args.query):
+        print(json.dumps(p) if args.json else p["name"])
+
+def command_export(args):
+    if args.query:
+        names = [p["name"] for p in get_catalog().select(args.query)]
+    else:
+        names = args.programs or [r[0] for r in get_connection().execute("SELECT name FROM names ORDER BY name;")]
+    for path, count in export_programs(names, args.format, args.gzip, args.combined):
+        print(f"{path}: {count} subdomains")
+
+def command_probe(args):
+    if args.new:
+        probe_file(args.tool, args.new)
+    else:
+        probe_database(args.tool, args.dir, args.programs or None)
+
+def command_stats(args):
+    stats = get_database_stats()
+    if args.index:
+        stats.update({f"index_{key}": value for key, value in get_catalog().stats.items()})
+    if args.json:
+        print(json.dumps(stats, indent=2))
+    else:
+        for key, value in stats.items():
+            print(f"{key:<24}{value}")
+
+def command_history(args):
+    for run_id, save_dir, started, finished, programs, added, removed in get_runs(args.limit):
+        print(f"{run_id}\t{started}\t{finished or '-'}\t{save_dir}\t{programs}\t+{added or 0}\t-{removed or 0}")
+
+def command_diff(args):
+    run_id = parse_run(args.run)
+    since = parse_run(args.since) if args.since else run_id - 1
+    path = args.output or f"run_{run_id}_diff.txt"
+    added, removed = write_run_diff(since, run_id, path)
+    print(f"{path}: {added} added, {removed} removed")
+
+def command_lookup(args):
+    count = 0
+    for subdomain, program, removed in iter_suffix(args.domain, args.removed):
+        count += 1
+        if not args.count:
+            print(f"{subdomain}\t{program}" + (f"\tremoved in run {removed}" if removed else ""))
+    if args.count:
+        print(count)
+
+def command_owner(args):
+    for host in args.hosts:
+        domain, owners = resolve_owner(host)
+        print(f"{host}\t{domain or '-'}\t" + ", ".join(f"{program} ({count})" for program, count in owners))
+
+def command_apexes(args):
+    for apex, count in get_apex_counts(args.program, args.limit):
+        print(f"{count}\t{apex}")
+
+def command_merge(args):
+    merge_shards(args.shards, args.dir)
+
+def command_cat(args):
+    if not STORE_DIR:
+        raise SystemExit("The program store is off (CHAOS_STORE is empty)")
+    if args.view is None and not args.programs:
+        raise SystemExit("Name programs or a --view")
+    missing = [name for name in args.programs if get_ref(name) is None]
+    if missing:
+        raise SystemExit(f"Not in the store: {', '.join(missing)}")
+    try:
+        for program, subdomain in iter_store(args.view, args.programs):
+            print(f"{program}\t{subdomain}" if args.program_column else subdomain)
+    except FileNotFoundError as e:
+        raise SystemExit(f"Not in the store: {e.filename}")
+
+def command_maintain(args):
+    size_before, size_after = maintain_database(vacuum=args.vacuum)
+    print(f"{DB_PATH}: {size_before / 1048576:.1f} MB -> {size_after / 1048576:.1f} MB")
+    removed, freed = prune_store()
+    if removed:
+        print(f"{STORE_DIR}: removed {removed} unreferenced zips ({freed / 1048576:.1f} MB)")
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Download and track subdomains from the Chaos dataset. Without a command the interactive menu starts."
+    )
+    commands = parser.add_subparsers(dest="command", metavar="command")
+
+    sync = commands.add_parser("sync", help="download the programs matching a filter query")
+    sync.add_argument("query", nargs="?", default="all", help='filter query, e.g. "platform=hackerone&bounty&changed" (default: all)')
+    sync.add_argument("--dir", help="output name for <dir>.txt and new_<dir>.txt (default: derived from the query)")
+    sync.add_argument("--probe", default=STREAM_PROBE, choices=["", *PROBE_TOOLS, "builtin"], help="probe new subdomains while downloading")
+    sync.add_argument("--force", action="store_true", help="ignore the HTTP cache and download every zip again")
+    sync.set_defaults(func=command_sync)
+
+    retry = commands.add_parser("retry", help="download the failed and deferred programs again")
+    retry.set_defaults(func=command_retry)
+
+    filter_ = commands.add_parser("filter", help="list the programs matching a filter query")
+    filter_.add_argument("query", nargs="?", default="all")
+    filter_.add_argument("--json", action="store_true", help="print the index entries as JSON lines")
+    filter_.set_defaults(func=command_filter)
+
+    export = commands.add_parser("export", help="export subdomains from the database")
+    export.add_argument("programs", nargs="*", help="program names (default: every program in the database)")
+    export.add_argument("--query", help="export the programs matching this filter query instead")
+    export.add_argument("--format", default="txt", choices=EXPORT_FORMATS)
+    export.add_argument("--gzip", action="store_true")
+    export.add_argument("--combined", metavar="NAME", help="write one <NAME>_exported file instead of one per program")
+    export.set_defaults(func=command_export)
+
+    probe = commands.add_parser("probe", help="probe subdomains from the database or a new_<dir>.txt file")
+    probe.add_argument("tool", choices=[*PROBE_TOOLS, "builtin"])
+    probe.add_argument("programs", nargs="*", help="only these programs (default: every current subdomain)")
+    probe.add_argument("--new", metavar="DIR", help="probe new_<DIR>.txt instead of the database")
+    probe.add_argument("--dir", default="database", help="output name for live_domains_<dir>_<tool>.txt")
+    probe.set_defaults(func=command_probe)
+
+    stats = commands.add_parser("stats", help="show database statistics")
+    stats.add_argument("--index", action="store_true", help="also fetch index.json and show its statistics")
+    stats.add_argument("--json", action="store_true")
+    stats.set_defaults(func=command_stats)
+
+    history = commands.add_parser("history", help="list recent runs")
+    history.add_argument("--limit", type=int, default=20)
+    history.set_defaults(func=command_history)
+
+    diff = commands.add_parser("diff", help="write the subdomains a run added (+) and removed (-)")
+    diff.add_argument("run", help="run ID or YYYY-MM-DD[ HH:MM:SS]")
+    diff.add_argument("--since", help="compare with this run instead of the one before")
+    diff.add_argument("--output", help="default: run_<ID>_diff.txt")
+    diff.set_defaults(func=command_diff)
+
+    lookup = commands.add_parser("lookup", help="list every known name under a domain, across all programs")
+    lookup.add_argument("domain", help="e.g. corp.example.com for corp.example.com and *.corp.example.com")
+    lookup.add_argument("--removed", action="store_true", help="include removed subdomains")
+    lookup.add_argument("--count", action="store_true", help="only print the number of names")
+    lookup.set_defaults(func=command_lookup)
+
+    owner = commands.add_parser("owner", help="find the programs that own hosts or their closest known parent domain")
+    owner.add_argument("hosts", nargs="+")
+    owner.set_defaults(func=command_owner)
+
+    apexes = commands.add_parser("apexes", help="count current subdomains per apex domain")
+    apexes.add_argument("--program", help="only this program")
+    apexes.add_argument("--limit", type=int, help="only the largest N apexes")
+    apexes.set_defaults(func=command_apexes)
+
+    merge = commands.add_parser("merge", help="fold shard databases (CHAOS_SHARD runs) into CHAOS_DB")
+    merge.add_argument("shards", nargs="+", help="shard database files")
+    merge.add_argument("--dir", default="all_programmes", help="output name for new_<dir>.txt and <dir>.txt")
+    merge.set_defaults(func=command_merge)
+
+    cat = commands.add_parser("cat", help="stream subdomains from the program store")
+    cat.add_argument("programs", nargs="*", help="the latest stored zips of these programs")
+    cat.add_argument("--view", metavar="DIR", help="every program of the last download into DIR")
+    cat.add_argument("--program-column", action="store_true", help="prefix each name with its program and a tab")
+    cat.set_defaults(func=command_cat)
+
+    maintain = commands.add_parser("maintain", help="refresh planner statistics, checkpoint the WAL and prune the store")
+    maintain.add_argument("--vacuum", action="store_true", help="also compact the database file")
+    maintain.set_defaults(func=command_maintain)
+    return parser
+
 if __name__ == "__main__":
-    os.system("clear")
-    main()
+    args = build_parser().parse_args()
+    if args.command is None:
+        os.system("clear")
+        main()
+    else:
+        try:
+            raise SystemExit(args.func(args) or 0)
+        except BrokenPipeError:
+            # Output piped into head and the like; keep Python from complaining again while flushing stdout at exit
+            os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+            raise SystemExit(1)